@@ -1,9 +1,43 @@
 """DataSuper - Organization for scientific projects."""
 
-from .repo import *
-from datasuper import database
-from .factories import *
+from importlib import import_module
+
 from .version import __version__
 
 
 __author__ = 'David C. Danko <dcdanko@gmail.com>'
+
+# modules whose public names are exported by this package, in order of
+# precedence. They are imported when one of their names is first used so
+# that importing a submodule such as `datasuper.cli` stays cheap.
+_exportedModules = [
+    'yaml_backed_structs',
+    'datasuper.repo_config',
+    'datasuper.repo',
+    'datasuper.factories',
+    'datasuper.server',
+]
+
+
+def _export():
+    exports = {}
+    for moduleName in _exportedModules:
+        module = import_module(moduleName)
+        for name, value in vars(module).items():
+            if not name.startswith('_'):
+                exports[name] = value
+    exports['database'] = import_module('datasuper.database')
+    globals().update(exports)
+    globals()['__all__'] = sorted(exports)
+
+
+def __getattr__(name):
+    if name.startswith('__') and name != '__all__':
+        raise AttributeError(name)
+    _export()
+    try:
+        return globals()[name]
+    except KeyError:
+        raise AttributeError(
+            'module {} has no attribute {}'.format(__name__, name)
+        ) from None
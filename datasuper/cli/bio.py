@@ -1,7 +1,7 @@
 from .cli import main
 import click
 from os.path import basename
-from datasuper import *
+from datasuper.repo import Repo
 
 
 @main.group()
@@ -39,7 +39,13 @@ def groupFastqs(fastqs, forwardSuffix, reverseSuffix):
 @click.argument('sample_type')
 @click.argument('fastqs', nargs=-1)
 def addSingleFastqs(suffix, name_prefix, sample_type, fastqs):
-    with Repo.loadRepo() as repo:
+    from datasuper.factories import (
+        getOrMakeFile,
+        getOrMakeResult,
+        getOrMakeSample,
+    )
+    repo = Repo.loadRepo()
+    with repo.transaction():
         for fq in fastqs:
             root = fq.split('/')[-1].split(suffix)[0]
             print('{}: {}'.format(root, fq))
@@ -65,8 +71,14 @@ def addSingleFastqs(suffix, name_prefix, sample_type, fastqs):
 @click.argument('fastqs', nargs=-1)
 def addFastqs(delim, forward_suffix, reverse_suffix,
               name_prefix, sample_type, fastqs):
+    from datasuper.factories import (
+        getOrMakeFile,
+        getOrMakeResult,
+        getOrMakeSample,
+    )
     groups = groupFastqs(fastqs, forward_suffix, reverse_suffix)
-    with Repo.loadRepo() as repo:
+    repo = Repo.loadRepo()
+    with repo.transaction():
         for root, (fq1, fq2) in groups.items():
             if delim:
                 root = root.split(delim)[0]
@@ -1,13 +1,65 @@
 import click
-from datasuper import *
-from datasuper.database import *
+import os
+import shlex
+import signal
 import sys
 from json import dumps as jdumps
+from json import loads as jloads
 
+from datasuper.errors import NoRepoFoundError, RepoAlreadyExistsError
+from datasuper.repo import Repo
 from ..version import __version__
 
+# the database and record modules are imported by the commands that use
+# them so that commands which only read the repo config start quickly
 
-@click.group()
+
+class ForwardingGroup(click.Group):
+    '''Runs commands in `datasuper serve` when it is running for the repo.
+
+    Set DATASUPER_LOCAL to always run commands in this process.
+    '''
+    # commands that always run here, `batch` may read stdin and `migrate`
+    # replaces the files of the database a server has open
+    localCommands = ('serve', 'batch', 'migrate')
+
+    def main(self, args=None, **kwargs):
+        if args is None:
+            args = sys.argv[1:]
+        response = self.forward(args)
+        if response is None:
+            return super(ForwardingGroup, self).main(args=args, **kwargs)
+        exitCode, out, err = response
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        sys.exit(exitCode)
+
+    @staticmethod
+    def forward(args):
+        '''Return the exit code, stdout and stderr of `args` run by the
+        server for the current repo, or None if it should run here.
+        '''
+        if not args or args[0] in ForwardingGroup.localCommands:
+            return None
+        if os.environ.get('DATASUPER_LOCAL'):
+            return None
+        if 'datasuper.server' in sys.modules:
+            if sys.modules['datasuper.server'].RepoServer.active:
+                return None
+        try:
+            repoPath = Repo.findRepo()
+        except (NoRepoFoundError, OSError):
+            return None
+        if not os.path.exists(os.path.join(repoPath, Repo.socketRoot)):
+            return None
+        from datasuper.server import RepoClient
+        try:
+            return RepoClient(repoPath).run(args)
+        except OSError:
+            return None
+
+
+@click.group(cls=ForwardingGroup)
 @click.version_option(__version__)
 def main():
     pass
@@ -22,21 +74,113 @@ def init():
         print('Repo already exists.', file=sys.stderr)
 
 
+@main.command()
+def serve():
+    '''Keep the repo open and run commands sent by the CLI until stopped.'''
+    from datasuper.errors import ServerRunningError
+    from datasuper.server import RepoServer
+    repo = Repo.loadRepo()
+    try:
+        server = RepoServer(repo, main)
+    except ServerRunningError:
+        print('A server is already running for this repo.', file=sys.stderr)
+        sys.exit(1)
+    server.warm()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print('Serving {}'.format(server.server_address), file=sys.stderr)
+    server.serve()
+
+
+def runBatchLine(line):
+    '''Run one line of a batch. Return an error message or None.'''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    try:
+        if line[0] in '[{':
+            args = jloads(line)
+            if isinstance(args, dict):
+                args = args['args']
+        else:
+            args = shlex.split(line)
+        if args and args[0] in ForwardingGroup.localCommands:
+            return 'cannot run {} in a batch'.format(args[0])
+        # lines run here, never in a server, so that they share the
+        # transaction of the batch
+        click.Group.main(main,
+                         args=[str(arg) for arg in args],
+                         prog_name='datasuper',
+                         standalone_mode=False)
+    except click.ClickException as e:
+        return e.format_message()
+    except click.Abort:
+        return 'aborted'
+    except SystemExit as e:
+        if e.code:
+            return 'exited with {}'.format(e.code)
+    except Exception as e:
+        return '{}: {}'.format(e.__class__.__name__, e)
+    return None
+
+
+@main.command()
+@click.argument('commands', type=click.File('r'), default='-')
+def batch(commands):
+    '''Run each line of COMMANDS (default stdin) in one transaction.
+
+    A line is a command as it would follow `datasuper`, e.g.
+    `add sample s1 env`, or a JSON list of its arguments. Every failing
+    line is reported and if any fails no records are saved.
+    '''
+    repo = Repo.loadRepo()
+    # commands that load the repo get this one, so their changes are
+    # kept in its transaction and written by a single flush
+    previous = Repo.served.get(repo.abspath, None)
+    Repo.served[repo.abspath] = repo
+    failed = 0
+    try:
+        with repo.transaction():
+            for lineNum, line in enumerate(commands, 1):
+                error = runBatchLine(line)
+                if error is not None:
+                    failed += 1
+                    print('line {}: {}'.format(lineNum, error), file=sys.stderr)
+            if failed:
+                raise click.ClickException(
+                    '{} commands failed, nothing was saved'.format(failed)
+                )
+    finally:
+        if previous is None:
+            del Repo.served[repo.abspath]
+        else:
+            Repo.served[repo.abspath] = previous
+
+
 @main.command()
 def id():
     '''Get the repo id of the current repo.'''
     repo = Repo.loadRepo()
     print(repo.repoId())
 
+
+@main.command()
+@click.argument('backend')
+def migrate(backend):
+    '''Convert the repo database to BACKEND, json, msgpack or sqlite.'''
+    from datasuper.database import BACKENDS, Database
+    if backend not in BACKENDS:
+        raise click.BadParameter('choose from ' + ', '.join(sorted(BACKENDS)))
+    repo = Repo.loadRepo()
+    Database.migrate(repo, backend)
+
 ###############################################################################
 
 
-def tableStatus(tbl, tblName):
-    '''Check if records in a table are valid and print a report to stdout.'''
-    ngrps = tbl.size()
-    sys.stdout.write('\n{} {}... '.format(ngrps, tblName))
+def tableStatus(statuses, tblName):
+    '''Print a report of the statuses of the records in a table.'''
+    sys.stdout.write('\n{} {}... '.format(len(statuses), tblName))
     allGood = True
-    for name, (status, msg) in tbl.checkStatus().items():
+    for name, (status, msg) in statuses.items():
         if not status:
             allGood = False
             sys.stdout.write(f'\n{name} failed: {msg}')
@@ -45,17 +189,78 @@ def tableStatus(tbl, tblName):
 
 
 @main.command()
-def status():
+@click.option('-i', '--incremental/--full', default=False,
+              help='Only check records whose data, files or referenced '
+                   'records changed since the last status.')
+def status(incremental):
     '''Check if all records are valid and print a report to stdout.'''
     repo = Repo.loadRepo()
     sys.stdout.write('Checking status')
-    tableStatus(repo.db.sampleGroupTable, 'sample groups')
-    tableStatus(repo.db.sampleTable, 'samples')
-    tableStatus(repo.db.resultTable, 'results')
-    tableStatus(repo.db.fileTable, 'files')
+    statuses = repo.db.checkStatus(incremental=incremental)
+    tableStatus(statuses['sample_groups'], 'sample groups')
+    tableStatus(statuses['samples'], 'samples')
+    tableStatus(statuses['results'], 'results')
+    tableStatus(statuses['file_records'], 'files')
     sys.stdout.write('\nDone\n')
 
 
+@main.command()
+@click.argument('file_names', nargs=-1)
+@click.option('-w', '--workers', type=int, default=None,
+              help='Number of files hashed at once.')
+@click.option('--upgrade/--no-upgrade', default=False,
+              help='Replace checksums of the first 4096 bytes of a file, '
+                   'stored when it was added, with full file checksums.')
+@click.option('-a', '--algorithm', default='sha256',
+              help='Algorithm of upgraded checksums, sha256, blake2b or, '
+                   'with xxhash installed, xxh64 or xxh3.')
+def verify(file_names, workers, upgrade, algorithm):
+    '''Check files against their checksums, FILE_NAMES or every file.'''
+    from datasuper.database import (
+        ALGORITHMS,
+        FileRecord,
+        HashReport,
+        mapInPool,
+        parseChecksum,
+    )
+    if algorithm not in ALGORITHMS:
+        raise click.BadParameter('choose from ' + ', '.join(sorted(ALGORITHMS)))
+    repo = Repo.loadRepo()
+    if file_names:
+        fileRecs = repo.db.fileTable.getMany(file_names)
+    else:
+        fileRecs = repo.db.fileTable.getAll()
+    statuses, report = FileRecord.verifyMany(fileRecs, workers=workers)
+    failed = 0
+    for name, (status, msg) in sorted(statuses.items()):
+        if not status:
+            failed += 1
+            print('{} failed: {}'.format(name, msg))
+    cache = repo.db.checksumCache
+    print('Verified {} files, {} failed. Hashed {}. Checksum cache: {} hits, '
+          '{} misses.'.format(len(statuses), failed, report, cache.hits, cache.misses),
+          file=sys.stderr)
+
+    if upgrade:
+        legacy = [
+            fileRec for fileRec in fileRecs
+            if statuses[fileRec.name][0] and parseChecksum(fileRec.checksum)[0] is None
+        ]
+        upgradeReport = HashReport()
+        checksums = mapInPool(
+            lambda fileRec: fileRec.fullChecksum(algorithm, report=upgradeReport),
+            legacy, workers=workers
+        )
+        with repo.transaction():
+            for fileRec, checksum in zip(legacy, checksums):
+                fileRec.checksum = checksum
+                fileRec.save(modify=True)
+        print('Upgraded {}'.format(upgradeReport.finish()), file=sys.stderr)
+
+    if failed:
+        sys.exit(1)
+
+
 ###############################################################################
 
 
@@ -69,6 +274,7 @@ def add():
 @click.argument('samples', nargs=-1)
 def addGroup(name, samples):
     '''Add a sample group to the repo.'''
+    from datasuper.database import SampleGroupRecord
     with Repo.loadRepo() as repo:
         sg = SampleGroupRecord(repo, name=name)
         sg.save()
@@ -79,6 +285,7 @@ def addGroup(name, samples):
 @click.argument('sample_type', default=None, nargs=1)
 def addSample(name, sample_type):
     '''Add a sample to the repo.'''
+    from datasuper.database import SampleRecord
     with Repo.loadRepo() as repo:
         sample = SampleRecord(repo, name=name, sample_type=sample_type)
         sample.save()
@@ -90,6 +297,7 @@ def addSample(name, sample_type):
 @click.argument('file_type', default=None, nargs=1)
 def addFile(name, filepath, file_type):
     '''Add a file record to the repo.'''
+    from datasuper.database import FileRecord
     with Repo.loadRepo() as repo:
         sample = FileRecord(repo,
                             name=name,
@@ -104,6 +312,7 @@ def addFile(name, filepath, file_type):
 @click.argument('fields', nargs=-1)
 def addResult(name, result_type, fields):
     '''Add a result records to the repo.'''
+    from datasuper.database import ResultRecord
     if ':' in fields[0]:
         fileRecs = {}
         for field in fields:
@@ -271,6 +480,65 @@ def viewResultSchema():
             sout += ' '.join(schema)
         print(sout)
 
+
+def parseCondition(condition):
+    '''Return the field and values of a FIELD=VALUE[,VALUE...] condition.'''
+    try:
+        field, values = condition.split('=', 1)
+    except ValueError:
+        raise click.BadParameter('conditions look like FIELD=VALUE, not ' + condition)
+    parsed = []
+    for value in values.split(','):
+        try:
+            parsed.append(jloads(value))
+        except ValueError:
+            parsed.append(value)
+    return field, parsed
+
+
+@main.command()
+@click.argument('table', type=click.Choice(['groups', 'samples', 'results', 'files']))
+@click.argument('conditions', nargs=-1)
+@click.option('-g', '--group', multiple=True,
+              help='Only match records in GROUP. May be repeated.')
+@click.option('--count', is_flag=True, help='Print the number of matches.')
+@click.option('--exists', is_flag=True,
+              help='Print nothing, exit with 1 if nothing matches.')
+def query(table, conditions, group, count, exists):
+    '''Print the records of TABLE that match every CONDITION.
+
+    A condition is FIELD=VALUE, e.g. `sample_type=env` or
+    `metadata__city=NYC`. Separate values with commas to match any of
+    them. Values are read as JSON where possible, e.g. numbers.
+    '''
+    from datasuper.database import (
+        FileRecord,
+        ResultRecord,
+        SampleGroupRecord,
+        SampleRecord,
+    )
+    recTypes = {
+        'groups': SampleGroupRecord,
+        'samples': SampleRecord,
+        'results': ResultRecord,
+        'files': FileRecord,
+    }
+    repo = Repo.loadRepo()
+    q = repo.query(recTypes[table])
+    for condition in conditions:
+        field, values = parseCondition(condition)
+        q = q.where(**{field: values})
+    if group:
+        q = q.inGroup(*group)
+    if exists:
+        sys.exit(0 if q.exists() else 1)
+    if count:
+        print(q.count())
+        return
+    for record in q:
+        print(record)
+
+
 ###############################################################################
 
 
@@ -344,6 +612,7 @@ def detail():
 @detail.command(name='sample')
 @click.argument('name')
 def detailSample(name):
+    from datasuper.database import InvalidRecordStateError
     repo = Repo.loadRepo()
     try:
         sample = repo.db.sampleTable.get(name)
@@ -382,6 +651,7 @@ def repairSamples():
 
     Checks all samples by default
     '''
+    from datasuper.database import InvalidRecordStateError
     with Repo.loadRepo() as repo:
         for rawRec in repo.db.sampleTable.getAllRaw():
             keyExists = []
@@ -447,6 +717,17 @@ def removeInvalids(confirmed):
         repo.db.fileTable.removeInvalids()
 
 
+@remove.command(name='stale-checksums')
+@click.option('-w', '--workers', type=int, default=None,
+              help='Number of files checked at once.')
+def removeStaleChecksums(workers):
+    '''Drop cached checksums of files that changed or left the repo.'''
+    repo = Repo.loadRepo()
+    filepaths = [fileRec.filepath() for fileRec in repo.db.fileTable.getAll()]
+    removed = repo.db.checksumCache.prune(filepaths, workers=workers)
+    print('Removed {} cached checksums'.format(removed), file=sys.stderr)
+
+
 @remove.command(name='results')
 @click.argument('result_names', nargs=-1)
 def removeResults(result_names):
@@ -460,11 +741,9 @@ def removeResults(result_names):
 @click.argument('result_types', nargs=-1)
 def removeResultsOfType(result_types):
     '''Remove the given results.'''
-    result_types = set(result_types)
     with Repo.loadRepo() as repo:
-        for result in repo.db.resultTable.getAll():
-            if result.resultType() in result_types:
-                result.remove()
+        for result in repo.db.resultTable.getByType(result_types):
+            result.remove()
 
 
 @remove.command(name='files')
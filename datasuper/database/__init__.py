@@ -1,8 +1,16 @@
 from .base_record import *
+from .checksums import *
+from .checksum_cache import *
+from .status_cache import *
+from .file_checks import *
 from .database_exceptions import *
 from .database import *
+from .backends import *
+from .name_index import *
+from .concurrency import *
 from .database_table import *
 from .file_record import *
 from .result import *
 from .sample_group import *
 from .sample import *
+from .query import *
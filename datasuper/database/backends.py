@@ -0,0 +1,503 @@
+import gc
+import os
+import sqlite3
+from sys import intern
+from tinydb import TinyDB
+from tinydb.storages import Storage
+from tinydb.middlewares import CachingMiddleware
+
+from .serializers import JSONSerializer, MsgpackSerializer
+
+
+class StorageBackend:
+    '''Abstract class for the on disk storage used by a database.
+
+    A backend hands out one table object per record table. Table objects
+    provide `all()`, `names()`, `insert(rec)`, `insertMany(recs)`,
+    `update(primaryKey, rec)` and `remove(primaryKey)`. `names()` returns
+    (primary key, name) pairs.
+
+    '''
+    name = None
+    fileName = None
+    # the generation of the files when the backend first read them
+    readGeneration = None
+
+    def table(self, tblName):
+        '''Return the backend table called `tblName`.'''
+        raise NotImplementedError()
+
+    def flush(self):
+        '''Write pending changes to disk.'''
+        raise NotImplementedError()
+
+    def close(self):
+        '''Write pending changes and release any open files.'''
+        raise NotImplementedError()
+
+    def compact(self):
+        '''Fold any incremental state back into the main database file.'''
+        pass
+
+    def rollback(self):
+        '''Discard every change made since the last flush.'''
+        raise NotImplementedError()
+
+    def generation(self):
+        '''Return a token that changes whenever the backend files change.'''
+        sig = []
+        for path in self.filePaths(self.repoPath):
+            try:
+                st = os.stat(path)
+                sig.append('{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                sig.append('-')
+        return '|'.join(sig)
+
+    @classmethod
+    def dbPath(cls, repoPath):
+        '''Return the path of the file backing this backend in `repoPath`.'''
+        return os.path.join(repoPath, cls.fileName)
+
+    @classmethod
+    def filePaths(cls, repoPath):
+        '''Return the paths of every file this backend keeps in `repoPath`.'''
+        return [cls.dbPath(repoPath)]
+
+    @classmethod
+    def existsIn(cls, repoPath):
+        '''Return True if `repoPath` contains a database of this type.'''
+        return os.path.isfile(cls.dbPath(repoPath))
+
+
+class SerializerStorage(Storage):
+    '''A TinyDB storage that reads and writes a file with `serializer`.
+
+    The file mtime is part of the database generation so, unlike TinyDB's
+    JSONStorage, opening the file does not touch it.
+
+    '''
+    serializer = JSONSerializer
+
+    def __init__(self, path, **kwargs):
+        Storage.__init__(self)
+        if not os.path.isfile(path):
+            open(path, 'a').close()
+        self.path = path
+        self.mode = 'b' if self.serializer.binary else ''
+        self._handle = open(path, 'r+' + self.mode)
+
+    def read(self):
+        self._handle.seek(0)
+        serialized = self._handle.read()
+        if not serialized:
+            return None
+        # parsing only allocates, collecting while the records are built
+        # would repeatedly traverse them for nothing
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self.serializer.loads(serialized)
+        finally:
+            if gcEnabled:
+                gc.enable()
+
+    def write(self, data):
+        '''Replace the file atomically by writing a copy and renaming it.'''
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w' + self.mode) as tmpFile:
+            tmpFile.write(self.serializer.dumps(data))
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.replace(tmpPath, self.path)
+        self._handle.close()
+        self._handle = open(self.path, 'r+' + self.mode)
+
+    def close(self):
+        self._handle.close()
+
+
+class MsgpackStorage(SerializerStorage):
+    '''A TinyDB storage that keeps its data in msgpack format.'''
+    serializer = MsgpackSerializer
+
+
+class TinyDBBackendTable:
+    '''Adapts a table in a TinyDB file to the backend table interface.
+
+    Records are read and changed directly in the cached data of the
+    TinyDB storage. The backend keeps a primary key -> element id map for
+    each table so updates and removals do not scan the table, TinyDB's own
+    table methods copy every element on each call.
+
+    Every change is also recorded with the backend so that it can be
+    appended to the journal.
+
+    '''
+
+    def __init__(self, backend, tblName):
+        self.backend = backend
+        self.tblName = tblName
+
+    @property
+    def data(self):
+        '''The element id -> record dict of this table.'''
+        return self.backend.tdb._storage.read().setdefault(self.tblName, {})
+
+    def all(self):
+        out = []
+        for rec in self.data.values():
+            rec['primary_key'] = intern(rec['primary_key'])
+            rec['name'] = intern(rec['name'])
+            out.append(dict(rec))
+        return out
+
+    def names(self):
+        return [(rec['primary_key'], rec['name']) for rec in self.data.values()]
+
+    def insert(self, rec):
+        self.insertMany([rec])
+
+    def insertMany(self, recs):
+        data, eids = self.data, self.backend.eids(self.tblName)
+        for rec in recs:
+            eid = str(self.backend.nextEids[self.tblName])
+            self.backend.nextEids[self.tblName] += 1
+            data[eid] = dict(rec)
+            eids[rec['primary_key']] = eid
+            self.backend.logChange('insert', self.tblName, rec['primary_key'], rec)
+
+    def update(self, primaryKey, rec):
+        eid = self.backend.eids(self.tblName)[primaryKey]
+        self.data[eid].update(rec)
+        self.backend.logChange('update', self.tblName, primaryKey, rec)
+
+    def remove(self, primaryKey):
+        eid = self.backend.eids(self.tblName).pop(primaryKey)
+        del self.data[eid]
+        self.backend.logChange('remove', self.tblName, primaryKey)
+
+
+class TinyDBBackend(StorageBackend):
+    '''Stores every table in a single TinyDB JSON file.
+
+    Changes are appended to a journal next to the JSON file when the
+    backend is flushed and replayed when it is opened. Each flush ends with
+    a commit line and replay ignores changes after the last one, so a flush
+    is applied entirely or not at all. Once the journal holds more than
+    `compactThreshold` changes it is folded back into the JSON file, which
+    is replaced atomically.
+
+    The JSON file is not read until a table is first used.
+
+    '''
+    name = 'json'
+    fileName = 'datasuper.tinydb.json'
+    journalName = 'datasuper.tinydb.journal'
+    storage = SerializerStorage
+    compactThreshold = 1000
+
+    def __init__(self, repoPath):
+        self.repoPath = repoPath
+        self.journalPath = os.path.join(repoPath, self.journalName)
+        self.pending = []
+        self.journalSize = 0
+        self.readGeneration = None
+        self._tdb = None
+        self._eids = {}
+        self.nextEids = {}
+
+    @property
+    def tdb(self):
+        '''The TinyDB database, read from disk the first time it is used.'''
+        if self._tdb is None:
+            storage = CachingMiddleware(self.storage)
+            storage.WRITE_CACHE_SIZE = 100 * 1000
+            self._tdb = TinyDB(self.dbPath(self.repoPath), storage=storage)
+            self.readGeneration = self.generation()
+            self.journalSize = self._replayJournal()
+        return self._tdb
+
+    def table(self, tblName):
+        return TinyDBBackendTable(self, tblName)
+
+    def eids(self, tblName):
+        '''Return the primary key -> element id map of `tblName`.'''
+        try:
+            return self._eids[tblName]
+        except KeyError:
+            pass
+        data = self.tdb._storage.read().setdefault(tblName, {})
+        self._eids[tblName] = {rec['primary_key']: eid for eid, rec in data.items()}
+        self.nextEids[tblName] = max([int(eid) for eid in data] + [0]) + 1
+        return self._eids[tblName]
+
+    def logChange(self, op, tblName, primaryKey, rec=None):
+        '''Record a change to be written to the journal on flush.'''
+        change = {'op': op, 'table': tblName, 'primary_key': primaryKey}
+        if rec is not None:
+            change['record'] = rec
+        self.pending.append(change)
+
+    def _replayJournal(self):
+        '''Apply the changes in the journal. Return the number applied.'''
+        if not os.path.isfile(self.journalPath):
+            return 0
+        changes, uncommitted = [], []
+        with open(self.journalPath) as journal:
+            for line in journal:
+                try:
+                    change = JSONSerializer.loads(line)
+                except ValueError:
+                    break  # a torn write at the end of the journal
+                if change['op'] == 'commit':
+                    changes += uncommitted
+                    uncommitted = []
+                else:
+                    uncommitted.append(change)
+        data = self.tdb._storage.read()
+        eidsByTable, nextEids = {}, {}
+        for change in changes:
+            tbl = data.setdefault(change['table'], {})
+            try:
+                eids = eidsByTable[change['table']]
+            except KeyError:
+                eids = {rec['primary_key']: eid for eid, rec in tbl.items()}
+                eidsByTable[change['table']] = eids
+                nextEids[change['table']] = max([int(el) for el in tbl] + [0]) + 1
+            # replaying must be idempotent since a crash between compacting
+            # and truncating the journal leaves changes in both places
+            eid = eids.get(change['primary_key'], None)
+            if change['op'] == 'remove':
+                if eid is not None:
+                    del tbl[eid]
+                    del eids[change['primary_key']]
+            elif eid is not None:
+                tbl[eid].update(change['record'])
+            else:
+                eid = str(nextEids[change['table']])
+                nextEids[change['table']] += 1
+                tbl[eid] = change['record']
+                eids[change['primary_key']] = eid
+        return len(changes)
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.journalSize + len(self.pending) > self.compactThreshold:
+            self.compact()
+            return
+        self.pending.append({'op': 'commit'})
+        lines = ''.join([
+            JSONSerializer.dumps(change) + '\n' for change in self.pending
+        ])
+        with open(self.journalPath, 'a') as journal:
+            journal.write(lines)
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journalSize += len(self.pending)
+        self.pending = []
+
+    def compact(self):
+        '''Rewrite the JSON file with every change and empty the journal.'''
+        storage = self.tdb._storage
+        storage.storage.write(storage.read())
+        storage._cache_modified_count = 0
+        if os.path.isfile(self.journalPath):
+            os.remove(self.journalPath)
+        self.journalSize = 0
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+        self._eids = {}
+        self.nextEids = {}
+        if self._tdb is not None:
+            self._tdb._storage.storage.close()
+            self._tdb = None
+
+    def close(self):
+        if self._tdb is None:
+            return
+        self.flush()
+        self._tdb._storage.storage.close()
+
+    @classmethod
+    def filePaths(cls, repoPath):
+        return [cls.dbPath(repoPath), os.path.join(repoPath, cls.journalName)]
+
+
+class SQLiteBackendTable:
+    '''Stores records of one table as JSON bodies in a SQLite table.
+
+    The primary key and name of each record are kept in their own indexed
+    columns so single records can be found without reading the table.
+    Changes are held by the backend until it is flushed.
+
+    '''
+
+    def __init__(self, backend, tblName):
+        self.backend = backend
+        self.conn = backend.conn
+        self.tblName = tblName
+        inSync = backend.generation() == backend.readGeneration
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS "{}" ('
+            'doc_id INTEGER PRIMARY KEY, '
+            'primary_key TEXT NOT NULL UNIQUE, '
+            'name TEXT NOT NULL, '
+            'body TEXT NOT NULL)'.format(tblName)
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS "{0}_name" ON "{0}" (name)'.format(tblName)
+        )
+        self.conn.commit()
+        if inSync:  # creating the table is not a change to merge
+            backend.readGeneration = backend.generation()
+
+    def _pending(self):
+        return self.backend.pending.get(self.tblName, {})
+
+    def _withPending(self, recs):
+        recs = {rec['primary_key']: rec for rec in recs}
+        for primaryKey, rec in self._pending().items():
+            if rec is None:
+                recs.pop(primaryKey, None)
+            else:
+                recs[primaryKey] = rec
+        return list(recs.values())
+
+    def all(self):
+        cursor = self.conn.execute(
+            'SELECT body FROM "{}" ORDER BY doc_id'.format(self.tblName)
+        )
+        return self._withPending([JSONSerializer.loads(body) for body, in cursor])
+
+    def names(self):
+        cursor = self.conn.execute(
+            'SELECT primary_key, name FROM "{}" ORDER BY doc_id'.format(self.tblName)
+        )
+        if not self._pending():
+            return cursor.fetchall()
+        recs = [{'primary_key': pk, 'name': name} for pk, name in cursor]
+        return [(rec['primary_key'], rec['name']) for rec in self._withPending(recs)]
+
+    def _change(self, primaryKey, rec):
+        # only the latest body of each record is kept, None removes it
+        self.backend.pending.setdefault(self.tblName, {})[primaryKey] = rec
+
+    def insert(self, rec):
+        self._change(rec['primary_key'], rec)
+
+    def insertMany(self, recs):
+        for rec in recs:
+            self.insert(rec)
+
+    def _current(self, primaryKey):
+        '''Return the stored record `primaryKey` with pending changes.'''
+        pending = self._pending()
+        if primaryKey in pending:
+            rec = pending[primaryKey]
+        else:
+            row = self.conn.execute(
+                'SELECT body FROM "{}" WHERE primary_key = ?'.format(self.tblName),
+                (primaryKey,)
+            ).fetchone()
+            rec = None if row is None else JSONSerializer.loads(row[0])
+        if rec is None:
+            raise KeyError(primaryKey)
+        return rec
+
+    def update(self, primaryKey, rec):
+        # updates are merged into the record, the whole record is written
+        self._change(primaryKey, dict(self._current(primaryKey), **rec))
+
+    def remove(self, primaryKey):
+        self._change(primaryKey, None)
+
+
+class SQLiteBackend(StorageBackend):
+    '''Stores each table in its own table of a SQLite database.
+
+    Changes are kept in memory and written in a single SQLite transaction
+    when the backend is flushed, so the database is only locked for the
+    duration of a flush.
+
+    '''
+    name = 'sqlite'
+    fileName = 'datasuper.sqlite'
+
+    def __init__(self, repoPath):
+        self.repoPath = repoPath
+        self.conn = sqlite3.connect(self.dbPath(repoPath))
+        self.readGeneration = self.generation()
+        self.pending = {}
+
+    def table(self, tblName):
+        return SQLiteBackendTable(self, tblName)
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            for tblName, changes in self.pending.items():
+                for primaryKey, rec in changes.items():
+                    if rec is None:
+                        self.conn.execute(
+                            'DELETE FROM "{}" WHERE primary_key = ?'.format(tblName),
+                            (primaryKey,)
+                        )
+                        continue
+                    body = JSONSerializer.dumps(rec)
+                    cursor = self.conn.execute(
+                        'UPDATE "{}" SET name = ?, body = ? '
+                        'WHERE primary_key = ?'.format(tblName),
+                        (rec['name'], body, primaryKey)
+                    )
+                    if cursor.rowcount == 0:
+                        self.conn.execute(
+                            'INSERT INTO "{}" (primary_key, name, body) '
+                            'VALUES (?, ?, ?)'.format(tblName),
+                            (primaryKey, rec['name'], body)
+                        )
+        self.pending = {}
+
+    def rollback(self):
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class MsgpackBackend(TinyDBBackend):
+    '''Stores every table in a single msgpack file.
+
+    Works like the JSON backend, including its journal, but the database
+    file is binary msgpack which is smaller and faster to load and dump.
+
+    '''
+    name = 'msgpack'
+    fileName = 'datasuper.tinydb.msgpack'
+    journalName = 'datasuper.tinydb.msgpack.journal'
+    storage = MsgpackStorage
+
+
+BACKENDS = {
+    TinyDBBackend.name: TinyDBBackend,
+    MsgpackBackend.name: MsgpackBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+
+def backendFor(repoPath):
+    '''Return the backend class used by the repo at `repoPath`.
+
+    A SQLite database takes precedence over a msgpack one and that over a
+    JSON one, new repos use JSON.
+
+    '''
+    for backend in [SQLiteBackend, MsgpackBackend]:
+        if backend.existsIn(repoPath):
+            return backend
+    return TinyDBBackend
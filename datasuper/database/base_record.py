@@ -1,15 +1,35 @@
+import copy
+from ast import literal_eval
 from .database_exceptions import (
     InvalidRecordStateError,
     RecordExistsError,
 )
 
 
+def parseMetadata(metadata):
+    '''Return stored metadata as a dict.
+
+    Older versions stored metadata as the repr of a dict, these strings
+    are parsed. Strings that are not a dict repr are returned unchanged.
+
+    '''
+    if isinstance(metadata, str):
+        try:
+            parsed = literal_eval(metadata)
+        except (ValueError, SyntaxError):
+            return metadata
+        if isinstance(parsed, dict):
+            return parsed
+    return metadata
+
+
 class BaseRecord:
     '''Abstract class providing functions common to all records.
 
     Attributes:
         repo (datasuper.Repo): The repo that contains this record.
-        db (datasuper.Database): The database that contains this record.
+        db (datasuper.Database): Alias to repo.db. The database that
+            contains this record.
         dbTable (datasuper.DatabaseTable): The table that contains this record.
         name (str): The human readable name of this record.
         primaryKey (str): The invariant machine readable name of this record.
@@ -17,22 +37,35 @@ class BaseRecord:
             convert to JSON.
 
     '''
+    # records have no __dict__, repos hold hundreds of thousands of them
+    __slots__ = ('repo', 'name', 'primaryKey', 'metadata', 'cachedStatus')
+    # the stored field holding the type of the record, if it has one
+    typeField = None
+    # stored fields holding primary keys of other records
+    refFields = []
 
     def __init__(self, repo, **kwargs):
         self.repo = repo
-        self.db = repo.db
-        self.dbTable = self.db.getTable(type(self))
         self.name = kwargs['name']
         try:
             self.primaryKey = kwargs['primary_key']
         except KeyError:
             self.primaryKey = None
         try:
-            self.metadata = kwargs['metadata']
+            # copied so that changes are only stored by `save`
+            self.metadata = copy.deepcopy(parseMetadata(kwargs['metadata']))
         except KeyError:
             self.metadata = {}
         self.cachedStatus = None
 
+    @property
+    def db(self):
+        return self.repo.db
+
+    @property
+    def dbTable(self):
+        return self.repo.db.getTable(type(self))
+
     def exists(self):
         '''Return True if this record has been saved at some point.'''
         return self.dbTable.exists(self.primaryKey)
@@ -60,7 +93,7 @@ class BaseRecord:
         elif nameExists and not modify:
             raise RecordExistsError('name_exists:{}'.format(self.name))
         elif pkExists and modify:
-            rec = self.dbTable.getRaw(self.primaryKey)
+            rec = copy.deepcopy(self.dbTable.getRaw(self.primaryKey))
             rec = self._mergeDicts(rec)
             self.dbTable.update(self.primaryKey, rec)
             return self.dbTable.get(self.primaryKey)
@@ -74,10 +107,39 @@ class BaseRecord:
             self.primaryKey = savedSelf.primaryKey
             return savedSelf
 
+    @classmethod
+    def saveMany(cls, repo, records):
+        '''Save several new records of this type with a single bulk insert.
+
+        Every record is checked before anything is written. Return the
+        records, which now have primary keys.
+
+        Args:
+            repo (datasuper.Repo): The repo to save the records in.
+            records (list): Unsaved records of this type.
+
+        Raises:
+            InvalidRecordStateError: If any record is not valid.
+            RecordExistsError: If any name is already in use.
+
+        '''
+        for record in records:
+            status, statusMsg = record.detailedStatus()
+            if not status:
+                raise InvalidRecordStateError(statusMsg)
+        newRecords = [record.to_dict() for record in records]
+        pks = repo.db.getTable(cls).insertMany(newRecords)
+        for record, pk in zip(records, pks):
+            record.primaryKey = pk
+        return records
+
     def _mergeDicts(self, rec):
         mydict = self.to_dict()
         for k, v in mydict.items():
-            if k in rec and isinstance(v, dict) and isinstance(rec[k], dict):
+            # metadata is replaced, so that removing a key is saved
+            if k == 'metadata':
+                rec[k] = v
+            elif k in rec and isinstance(v, dict) and isinstance(rec[k], dict):
                 for subk, subv in v.items():
                     rec[k][subk] = subv
             else:
@@ -138,6 +200,6 @@ class BaseRecord:
         out = {
             'primary_key': self.primaryKey,
             'name': self.name,
-            'metadata': str(self.metadata)
+            'metadata': copy.deepcopy(self.metadata),
         }
         return out
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+
+from .checksums import hashFile, mapInPool
+
+
+def statSignature(filepath):
+    '''Return (device, inode, size, mtime in ns) of `filepath`.'''
+    st = os.stat(filepath)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class ChecksumCache:
+    '''Persists full file checksums keyed by the stat signature of the file.
+
+    A file is only hashed again once its device, inode, size or mtime
+    change. Each entry is a line of the cache file,
+    `[device, inode, size, mtime_ns, algorithm, checksum]`. New entries are
+    appended when the database is flushed, later lines take precedence.
+    Entries for files that changed or are no longer in the repo are left
+    until `prune` rewrites the file.
+
+    The cache can be used from several threads at once.
+
+    '''
+    fileName = 'datasuper.checksums.jsonl'
+
+    def __init__(self, db):
+        self.path = os.path.join(db.repo.abspath, ChecksumCache.fileName)
+        self.entries = None
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            with open(self.path) as cacheFile:
+                for line in cacheFile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # a torn write at the end of the file
+                    self.entries[tuple(entry[:5])] = entry[5]
+        except OSError:
+            pass
+
+    def checksum(self, filepath, algorithm, report=None):
+        '''Return the checksum of `filepath`, hashing it only on a miss.
+
+        Args:
+            filepath (str): The file to hash.
+            algorithm (str): One of `checksums.ALGORITHMS`.
+            report (:obj:`HashReport`, optional): Counts the bytes hashed.
+
+        '''
+        signature = statSignature(filepath)
+        key = signature + (algorithm,)
+        with self._lock:
+            self._load()
+            try:
+                checksum = self.entries[key]
+                self.hits += 1
+                return checksum
+            except KeyError:
+                self.misses += 1
+        checksum = hashFile(filepath, algorithm, report=report)
+        # a file written to while it was hashed is not cached
+        if statSignature(filepath) == signature:
+            with self._lock:
+                self.entries[key] = checksum
+                self.pending.append(list(key) + [checksum])
+        return checksum
+
+    def save(self):
+        '''Append new entries to the cache file.'''
+        with self._lock:
+            if not self.pending:
+                return
+            lines = ''.join([json.dumps(entry) + '\n' for entry in self.pending])
+            try:
+                with open(self.path, 'a') as cacheFile:
+                    cacheFile.write(lines)
+            except OSError:
+                return  # the repo may not be writable, entries are kept
+            self.pending = []
+
+    def prune(self, filepaths, workers=None):
+        '''Drop entries that do not match the current state of `filepaths`.
+
+        Return the number of entries removed.
+        '''
+        def signature(filepath):
+            try:
+                return statSignature(filepath)
+            except OSError:
+                return None
+
+        current = set(mapInPool(signature, filepaths, workers=workers))
+        with self._lock:
+            self._load()
+            kept = {key: checksum for key, checksum in self.entries.items()
+                    if key[:4] in current}
+            tmpPath = self.path + '.tmp'
+            with open(tmpPath, 'w') as cacheFile:
+                for key, checksum in kept.items():
+                    cacheFile.write(json.dumps(list(key) + [checksum]) + '\n')
+            os.replace(tmpPath, self.path)
+            removed = len(self.entries) - len(kept)
+            self.entries = kept
+            self.pending = []
+        return removed
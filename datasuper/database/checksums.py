@@ -0,0 +1,119 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# algorithm name -> constructor of a hashlib style hash object
+ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+if xxhash is not None:
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+    ALGORITHMS['xxh3'] = xxhash.xxh3_128
+
+DEFAULT_ALGORITHM = 'sha256'
+# bytes read at a time, each worker holds one buffer of this size
+CHUNK_SIZE = 1024 * 1024
+# hashing mostly waits on reads, which release the GIL
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def parseChecksum(checksum):
+    '''Return the algorithm and digest of a stored checksum.
+
+    Full file checksums are stored as `<algorithm>:<hex digest>`. The
+    checksums stored when a file is added are a bare SHA-256 of the first
+    4096 bytes of the file, for these the algorithm is None.
+
+    '''
+    algorithm, sep, digest = checksum.partition(':')
+    if not sep:
+        return None, checksum
+    return algorithm, digest
+
+
+class HashReport:
+    '''Counts the files and bytes hashed and the time it took.'''
+
+    def __init__(self):
+        self.files = 0
+        self.nbytes = 0
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.files += 1
+            self.nbytes += nbytes
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    def throughput(self):
+        '''Return the bytes hashed per second.'''
+        if not self.seconds:
+            return 0.0
+        return self.nbytes / self.seconds
+
+    def __str__(self):
+        return '{} files, {:.1f} MB in {:.2f}s ({:.1f} MB/s)'.format(
+            self.files, self.nbytes / 1e6, self.seconds, self.throughput() / 1e6
+        )
+
+
+def hashFile(filepath, algorithm=DEFAULT_ALGORITHM, chunkSize=CHUNK_SIZE,
+             report=None):
+    '''Return the checksum of the whole file as `<algorithm>:<digest>`.
+
+    The file is read in chunks of `chunkSize` bytes into one buffer.
+
+    Raises:
+        ValueError: If `algorithm` is not available.
+        OSError: If the file cannot be read.
+    '''
+    try:
+        hasher = ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError('unknown checksum algorithm {}, choose from {}'.format(
+            algorithm, ', '.join(sorted(ALGORITHMS))
+        ))
+    buf = bytearray(chunkSize)
+    view = memoryview(buf)
+    nbytes = 0
+    with open(filepath, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            nbytes += n
+    if report is not None:
+        report.add(nbytes)
+    return '{}:{}'.format(algorithm, hasher.hexdigest())
+
+
+def headChecksum(filepath):
+    '''Return the SHA-256 of the first 4096 bytes, stored for new files.'''
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read(4096)).hexdigest()
+
+
+def mapInPool(func, items, workers=None):
+    '''Return `[func(item) for item in items]` computed by `workers` threads.'''
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
@@ -0,0 +1,65 @@
+import fcntl
+import os
+from .database_exceptions import ConcurrentWriteError
+
+
+class RepoLock:
+    '''An exclusive advisory lock on a repo, held while writing to it.
+
+    Uses `fcntl.lockf` which, unlike `flock`, is honoured by most network
+    filesystems that cluster jobs share a repo over.
+
+    '''
+    fileName = 'datasuper.lock'
+
+    def __init__(self, repoPath):
+        self.path = os.path.join(repoPath, RepoLock.fileName)
+        self.lockFile = None
+
+    def __enter__(self):
+        self.lockFile = open(self.path, 'a')
+        fcntl.lockf(self.lockFile, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.lockf(self.lockFile, fcntl.LOCK_UN)
+        self.lockFile.close()
+        self.lockFile = None
+
+
+_MISSING = object()
+
+
+def _mergeValue(key, base, ours, theirs):
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+    if all(isinstance(el, list) for el in (base, ours, theirs)):
+        kept = [el for el in theirs if el in ours or el not in base]
+        return kept + [el for el in ours if el not in base and el not in theirs]
+    if all(isinstance(el, dict) for el in (base, ours, theirs)):
+        return mergeRecords(base, ours, theirs)
+    raise ConcurrentWriteError('conflicting changes to field {}'.format(key))
+
+
+def mergeRecords(base, ours, theirs):
+    '''Return a three way merge of two changed copies of a raw record.
+
+    Fields changed on one side only take that side's value. Lists changed
+    on both sides keep what either side added and drop what either side
+    removed, dicts are merged field by field.
+
+    Raises:
+        ConcurrentWriteError: If both sides changed a field differently.
+
+    '''
+    merged = {}
+    for key in set(base) | set(ours) | set(theirs):
+        value = _mergeValue(key,
+                            base.get(key, _MISSING),
+                            ours.get(key, _MISSING),
+                            theirs.get(key, _MISSING))
+        if value is not _MISSING:
+            merged[key] = value
+    return merged
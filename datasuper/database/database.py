@@ -1,12 +1,15 @@
-from tinydb import TinyDB
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
 import os
+from .backends import BACKENDS, backendFor
+from .checksum_cache import ChecksumCache
+from .concurrency import RepoLock, mergeRecords
+from .database_exceptions import ConcurrentWriteError
 from .database_table import DatabaseTable
+from .name_index import NameIndex
 from .file_record import FileRecord
 from .result import ResultRecord
 from .sample_group import SampleGroupRecord
 from .sample import SampleRecord
+from .status_cache import StatusCache
 
 
 class Database:
@@ -17,58 +20,71 @@ class Database:
     sampleTblName = 'sample_record_table'
     sampleGroupTblName = 'sample_group_record_tbl'
 
-    def __init__(self, repo, readOnly, tinyDB):
+    def __init__(self, repo, readOnly, backend):
         self.repo = repo
         self.readOnly = readOnly
-        self.tdb = tinyDB
-        self.pkToNameTable = None
-        self.nameToPKTable = None
+        self.backend = backend
+        self.nameIndex = NameIndex(self)
+        self.refsTo = None
+        self.refsFrom = None
+        self.inTransaction = False
+        self._checksumCache = None
         self.fileTable = DatabaseTable(self,
                                        self.readOnly,
                                        FileRecord,
-                                       self.tdb.table(Database.fileTblName))
+                                       Database.fileTblName)
 
         self.resultTable = DatabaseTable(self,
                                          self.readOnly,
                                          ResultRecord,
-                                         self.tdb.table(Database.resultTblName))
+                                         Database.resultTblName)
 
         self.sampleTable = DatabaseTable(self,
                                          self.readOnly,
                                          SampleRecord,
-                                         self.tdb.table(Database.sampleTblName))
+                                         Database.sampleTblName)
 
         self.sampleGroupTable = DatabaseTable(self,
                                               self.readOnly,
                                               SampleGroupRecord,
-                                              self.tdb.table(Database.sampleGroupTblName))
+                                              Database.sampleGroupTblName)
 
-    def _buildPKNameTables(self):
-        if self.pkToNameTable is not None:
-            return
-        self.pkToNameTable = {}
-        self.nameToPKTable = {}
+    @property
+    def checksumCache(self):
+        '''The cache of file checksums, read the first time it is used.'''
+        if self._checksumCache is None:
+            self._checksumCache = ChecksumCache(self)
+        return self._checksumCache
 
-        def handleTable(tbl):
-            for rec in tbl.getAllRaw():
-                rec_pk, rec_name = rec['primary_key'], rec['name']
-                self.pkToNameTable[rec_pk] = rec_name
-                self.nameToPKTable[rec_name] = rec_pk
+    def tables(self):
+        '''Return a list of every table in the database.'''
+        return [
+            self.fileTable,
+            self.resultTable,
+            self.sampleTable,
+            self.sampleGroupTable,
+        ]
 
-        handleTable(self.fileTable)
-        handleTable(self.resultTable)
-        handleTable(self.sampleTable)
-        handleTable(self.sampleGroupTable)
+    def _tablesByLoadState(self):
+        # tables whose names are already loaded are searched first so that
+        # resolving a name only loads other tables when it has to
+        tbls = self.tables()
+        return [tbl for tbl in tbls if tbl.namesLoaded()] + \
+               [tbl for tbl in tbls if not tbl.namesLoaded()]
 
     def pkNotUsed(self, primaryKey):
         '''Return True if `primaryKey` has not been used, else False.'''
-        self._buildPKNameTables()
-        return not (primaryKey in self.pkToNameTable)
+        for tbl in self.tables():
+            if tbl.hasPK(primaryKey):
+                return False
+        return True
 
     def nameNotUsed(self, name):
         '''Return True if `name` has not been used, else False.'''
-        self._buildPKNameTables()
-        return not (name in self.nameToPKTable)
+        for tbl in self.tables():
+            if tbl.hasName(name):
+                return False
+        return True
 
     def asPK(self, name):
         '''Return a primary key corresponding to name.
@@ -76,22 +92,15 @@ class Database:
         If `name` is actually a primary key return `name`.
 
         '''
-        self._buildPKNameTables()
-        try:
-            pk = self.nameToPKTable[name]
-        except KeyError as ke:
-            if name in self.pkToNameTable:
-                pk = name
-            else:
-                try:
-                    pk = name.primaryKey
-                except AttributeError:
-                    raise ke
-        return pk
+        for tbl in self._tablesByLoadState():
+            try:
+                return tbl.asPK(name)
+            except KeyError:
+                pass
+        raise KeyError(name)
 
     def asPKs(self, names):
         '''Return a set of primary keys corresponding to `names`.'''
-        self._buildPKNameTables()
         pks = set()
         for name in names:
             pks.add(self.asPK(name))
@@ -99,24 +108,91 @@ class Database:
 
     def asName(self, pk):
         '''Return a (human readable) name corresponding to `pk`.'''
-        self._buildPKNameTables()
-        try:
-            name = self.pkToNameTable[pk]
-        except KeyError as ke:
-            if pk in self.nameToPKTable:
-                name = pk
-            else:
-                raise ke
-        return name
+        for tbl in self._tablesByLoadState():
+            try:
+                return tbl.asName(pk)
+            except KeyError:
+                pass
+        raise KeyError(pk)
 
     def asNames(self, pks):
         '''Return a list of names corresponding to `pks`.'''
-        self._buildPKNameTables()
         names = []
         for pk in pks:
-            names.append(self.asName(name))
+            names.append(self.asName(pk))
         return names
 
+    def _refsIn(self, recType, rawRec):
+        for field in recType.refFields:
+            refs = rawRec.get(field, None) or []
+            if isinstance(refs, dict):
+                refs = refs.values()
+            for ref in refs:
+                yield field, ref
+
+    def _buildRefIndex(self):
+        if self.refsTo is not None:
+            return
+        self.refsTo = {}
+        self.refsFrom = {}
+        for tbl in self.tables():
+            if not tbl.typeStored.refFields:
+                continue
+            for rawRec in tbl.getAllRaw():
+                self._addRefs(tbl.typeStored, rawRec['primary_key'], rawRec)
+
+    def _addRefs(self, recType, primaryKey, rawRec):
+        edges = set(self._refsIn(recType, rawRec))
+        self.refsFrom[primaryKey] = edges
+        for field, ref in edges:
+            self.refsTo.setdefault(ref, set()).add((field, primaryKey))
+
+    def reindexRefs(self, recType, primaryKey, rawRec):
+        '''Update the references made by `primaryKey`, drop them if None.'''
+        if self.refsTo is None or not recType.refFields:
+            return
+        for field, ref in self.refsFrom.pop(primaryKey, set()):
+            self.refsTo[ref].discard((field, primaryKey))
+        if rawRec is not None:
+            self._addRefs(recType, primaryKey, rawRec)
+
+    def referrers(self, primaryKey, fields=None):
+        '''Return the primary keys of records that reference `primaryKey`.
+
+        Args:
+            primaryKey (str): The referenced record.
+            fields (:obj:`list`, optional): Only count references made
+                through these fields (e.g. `results`). Defaults to all.
+
+        '''
+        self._buildRefIndex()
+        primaryKey = self.asPK(primaryKey)
+        return {
+            referrer
+            for field, referrer in self.refsTo.get(primaryKey, set())
+            if fields is None or field in fields
+        }
+
+    def isOrphan(self, primaryKey):
+        '''Return True if no record references `primaryKey`.'''
+        return not self.referrers(primaryKey)
+
+    def dependents(self, primaryKey):
+        '''Return the primary keys of every record that depends on `primaryKey`.
+
+        This follows references transitively, e.g. a file is depended on by
+        its results, their samples and the groups containing those.
+
+        '''
+        out = set()
+        stack = [self.asPK(primaryKey)]
+        while stack:
+            for referrer in self.referrers(stack.pop()):
+                if referrer not in out:
+                    out.add(referrer)
+                    stack.append(referrer)
+        return out
+
     def getTable(self, recType):
         '''Return the table appropriate for `recType`.'''
         if recType == FileRecord:
@@ -129,27 +205,152 @@ class Database:
             return self.sampleGroupTable
 
     def flush(self):
-        """Write data to disk."""
-        self.tdb._storage.flush()
+        """Write data to disk, unless a transaction is open.
+
+        Changes are written while holding the repo lock. If another process
+        wrote to the database since it was read, changes are merged into
+        what is on disk instead.
+
+        Raises:
+            ConcurrentWriteError: If the changes conflict with those of
+                another process. Nothing is written.
+
+        """
+        if self._checksumCache is not None:
+            self._checksumCache.save()
+        if self.inTransaction:
+            return
+        if not any(tbl.changes for tbl in self.tables()):
+            return
+        with RepoLock(self.repo.abspath):
+            if self.backend.generation() != self.backend.readGeneration:
+                self._mergeIntoDisk()
+            else:
+                self.backend.flush()
+                self.nameIndex.flush()
+            self.backend.readGeneration = self.backend.generation()
+        for tbl in self.tables():
+            tbl.changes = {}
+
+    def _mergeIntoDisk(self):
+        '''Apply changes to the database on disk then forget what was read.'''
+        current = type(self.backend)(self.repo.abspath)
+        diskNames = set()
+        for tbl in self.tables():
+            diskNames |= {name for _, name in current.table(tbl.tblName).names()}
+
+        writes = []
+        for tbl in self.tables():
+            if not tbl.changes:
+                continue
+            currentTbl = current.table(tbl.tblName)
+            onDisk = {rec['primary_key']: rec for rec in currentTbl.all()}
+            for pk, (op, base) in tbl.changes.items():
+                theirs = onDisk.get(pk, None)
+                if op == 'insert':
+                    ours = tbl.getRaw(pk)
+                    if ours['name'] in diskNames:
+                        raise ConcurrentWriteError('name taken: ' + ours['name'])
+                    writes.append((currentTbl.insert, (ours,)))
+                elif op == 'remove':
+                    if theirs is not None:
+                        writes.append((currentTbl.remove, (pk,)))
+                elif theirs is None:
+                    raise ConcurrentWriteError('record removed: ' + base['name'])
+                else:
+                    merged = mergeRecords(base, tbl.getRaw(pk), theirs)
+                    if merged['name'] != theirs['name'] and merged['name'] in diskNames:
+                        raise ConcurrentWriteError('name taken: ' + merged['name'])
+                    writes.append((currentTbl.update, (pk, merged)))
+
+        self.backend.rollback()
+        for write, args in writes:
+            write(*args)
+        current.close()
+        # the index only matches the database as this process read it
+        self.nameIndex.invalidate()
+        self._resetCaches()
+
+    def begin(self):
+        '''Keep changes in memory until `commit` or `rollback` is called.'''
+        self.flush()
+        self.inTransaction = True
+
+    def commit(self):
+        '''Write every change made since `begin` in one flush.'''
+        self.inTransaction = False
+        self.flush()
+
+    def rollback(self):
+        '''Discard every change made since `begin`.'''
+        self.inTransaction = False
+        self.backend.rollback()
+        self._resetCaches()
+
+    def _resetCaches(self):
+        for tbl in self.tables():
+            tbl.clearCaches()
+        self.nameIndex = NameIndex(self)
+        self.refsTo = None
+        self.refsFrom = None
 
     def close(self):
         '''Close the database.'''
-        self.tdb.close()
-
-    def checkStatus(self):
-        out = {
-            'sample_groups': self.sampleGroupTable.checkStatus(),
-            'samples': self.sampleTable.checkStatus(),
-            'results': self.resultTable.checkStatus(),
-            'file_records': self.fileTable.checkStatus()
-        }
-        return out
+        self.flush()
+        self.backend.close()
+
+    def checkStatus(self, incremental=False, workers=None):
+        '''Return the status of every record by table and record name.
+
+        Every record is evaluated once, in one pass over the tables, and
+        the statuses are saved with the inputs they were computed from so
+        that a later incremental check can reuse them.
+
+        Args:
+            incremental (:obj:`bool`, optional): Only check records whose
+                data, files or referenced records changed since the last
+                status, see `StatusCache`. Defaults to False.
+            workers (:obj:`int`, optional): The number of directories
+                checked at once.
+
+        '''
+        return StatusCache(self).check(workers=workers, incremental=incremental)
 
     @staticmethod
     def loadDatabase(repo, path, readOnly):
         '''Load the database from a repo directory.'''
-        dbPath = os.path.join(repo.abspath, Database.dbName)
-        storage = CachingMiddleware(JSONStorage)
-        storage.WRITE_CACHE_SIZE = 100 * 1000
-        tinydbDB = TinyDB(dbPath, storage=storage)
-        return Database(repo, readOnly, tinydbDB)
+        backend = backendFor(repo.abspath)(repo.abspath)
+        return Database(repo, readOnly, backend)
+
+    @staticmethod
+    def migrate(repo, backendName):
+        '''Copy every record into a new `backendName` database.
+
+        The file of the old backend is kept with a `.bak` suffix so that
+        the new database is the one picked up by `loadDatabase`.
+
+        '''
+        source = repo.db
+        targetCls = BACKENDS[backendName]
+        if type(source.backend) is targetCls:
+            return
+        for targetPath in targetCls.filePaths(repo.abspath):
+            if os.path.isfile(targetPath):
+                os.rename(targetPath, targetPath + '.bak')
+        target = targetCls(repo.abspath)
+        sourceTables = {
+            Database.fileTblName: source.fileTable,
+            Database.resultTblName: source.resultTable,
+            Database.sampleTblName: source.sampleTable,
+            Database.sampleGroupTblName: source.sampleGroupTable,
+        }
+        for tblName, sourceTbl in sourceTables.items():
+            targetTbl = target.table(tblName)
+            for rawRec in sourceTbl.getAllRaw():
+                targetTbl.insert(dict(rawRec))
+        target.close()
+        source.backend.compact()
+        source.close()
+        for sourcePath in type(source.backend).filePaths(repo.abspath):
+            if os.path.isfile(sourcePath):
+                os.rename(sourcePath, sourcePath + '.bak')
@@ -26,3 +26,7 @@ class SchemaMismatchError(Exception):
                '\tFile Record:\n{}\n')
         msg = msg.format(resultType, pk, schema, fileRecs)
         raise cls(msg)
+
+
+class ConcurrentWriteError(Exception):
+    pass
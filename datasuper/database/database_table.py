@@ -1,6 +1,10 @@
-from tinydb import where
+from collections import OrderedDict
+import copy
 from random import choice as rchoice
 import string
+from sys import intern
+from .base_record import parseMetadata
+from .status_cache import StatusCache
 from .database_exceptions import (
     InvalidRecordStateError,
     SchemaMismatchError,
@@ -11,47 +15,167 @@ from .database_exceptions import (
 
 class DatabaseTable:
     """Stores and manipulates database records of a given type."""
+    # number of records kept by `get`, least recently used are dropped
+    recordCacheSize = 100 * 1000
 
-    def __init__(self, db, readOnly, typeStored, tinydbTbl):
+    def __init__(self, db, readOnly, typeStored, tblName):
         self.repo = db.repo
         self.db = db
-        self.tbl = tinydbTbl
+        self.tblName = tblName
+        self._tbl = None
         self.typeStored = typeStored
         self.pk_raw_index = None
         self.pk_index = None
         self.cached_raw = None
         self.cached_recs = None
+        self.pkToName = None
+        self.nameToPK = None
+        self.field_indexes = {}
+        self.metadata_index = None
+        self.changes = {}
+        self.recordCache = OrderedDict()
+
+    def clearCaches(self):
+        """Forget every record and index read from the backend."""
+        self._tbl = None
+        self.pk_raw_index = None
+        self.pk_index = None
+        self.cached_raw = None
+        self.cached_recs = None
+        self.pkToName = None
+        self.nameToPK = None
+        self.field_indexes = {}
+        self.metadata_index = None
+        self.changes = {}
+        self.recordCache = OrderedDict()
+
+    def clearRecords(self):
+        """Forget records built by `get` and `getAll`, with the statuses
+        they cached. Raw records and indexes are kept.
+        """
+        self.cached_recs = None
+        self.recordCache = OrderedDict()
+
+    @property
+    def tbl(self):
+        """The backend table, opened the first time it is used."""
+        if self._tbl is None:
+            self._tbl = self.db.backend.table(self.tblName)
+        return self._tbl
+
+    def namesLoaded(self):
+        """Return True if the name table for this table has been built."""
+        return self.nameToPK is not None
+
+    def _buildNameTables(self):
+        if self.nameToPK is not None:
+            return
+        self.pkToName = self.db.nameIndex.pkToName(self.tblName)
+        self.nameToPK = {
+            rec_name: rec_pk for rec_pk, rec_name in self.pkToName.items()
+        }
+
+    def hasPK(self, primaryKey):
+        """Return True if `primaryKey` is used in this table."""
+        self._buildNameTables()
+        return primaryKey in self.pkToName
+
+    def hasName(self, name):
+        """Return True if `name` is used in this table."""
+        self._buildNameTables()
+        return name in self.nameToPK
+
+    def asPK(self, name):
+        """Return the primary key for `name` in this table.
+
+        If `name` is actually a primary key return `name`. Only this table
+        is loaded to resolve the name.
+
+        """
+        self._buildNameTables()
+        try:
+            pk = self.nameToPK[name]
+        except KeyError as ke:
+            if name in self.pkToName:
+                pk = name
+            else:
+                try:
+                    pk = name.primaryKey
+                except AttributeError:
+                    raise ke
+        return pk
+
+    def asPKs(self, names):
+        """Return a set of primary keys in this table for `names`."""
+        return {self.asPK(name) for name in names}
+
+    def asName(self, primaryKey):
+        """Return the name for `primaryKey` in this table."""
+        self._buildNameTables()
+        try:
+            name = self.pkToName[primaryKey]
+        except KeyError as ke:
+            if primaryKey in self.nameToPK:
+                name = primaryKey
+            else:
+                raise ke
+        return name
 
     def _newPrimaryKey(self):
         """Return a new random string for use as a primary key."""
         N = 20
         chars = string.ascii_uppercase + string.digits
         pk = [rchoice(chars) for _ in range(N)]
-        pk = ''.join(pk)
+        pk = intern(''.join(pk))
         return pk
 
+    def _trackChange(self, primaryKey, op):
+        """Note that `primaryKey` is about to change by `op`.
+
+        `changes` maps each primary key changed since the last flush to
+        the kind of change and a copy of the record as it was read, which
+        is what a merge with a concurrent writer is based on.
+
+        """
+        try:
+            oldOp, base = self.changes[primaryKey]
+        except KeyError:
+            base = None
+            if op != 'insert':
+                base = copy.deepcopy(self.getRaw(primaryKey))
+            self.changes[primaryKey] = (op, base)
+            return
+        if oldOp != 'insert':
+            self.changes[primaryKey] = (op, base)
+        elif op == 'remove':
+            del self.changes[primaryKey]
+
     def rename(self, primaryKey, newName):
         """Change name of `primaryKey` to `newName` then return the record."""
         if self.repo.readOnly:
             raise RepoReadOnlyError()
+        primaryKey = self.asPK(primaryKey)
+        self._trackChange(primaryKey, 'update')
+        self.recordCache.pop(primaryKey, None)
         rawRec = self.getRaw(primaryKey)
         oldName = rawRec['name']
         rawRec['name'] = newName
-        self.tbl.update(rawRec, eids=[rawRec.eid])
+        self.tbl.update(primaryKey, rawRec)
 
-        del self.db.nameToPKTable[oldName]
-        self.db.nameToPKTable[newName] = primaryKey
-        self.db.pkToNameTable[primaryKey] = newName
+        del self.nameToPK[oldName]
+        self.nameToPK[newName] = primaryKey
+        self.pkToName[primaryKey] = newName
+        self.db.nameIndex.logChange(self.tblName, primaryKey, newName)
 
         return self.get(primaryKey)
 
     def exists(self, primaryKey):
         """Return True if `primaryKey` is in the table, else False."""
         try:
-            primaryKey = self.db.asPK(primaryKey)
+            primaryKey = self.asPK(primaryKey)
         except KeyError:
             return False
-        if not self.pk_index:
+        if self.pk_index is None:
             self._build_pk_index()
         return primaryKey in self.pk_index
 
@@ -62,26 +186,179 @@ class DatabaseTable:
         }
         self.pk_index = self.pk_raw_index
 
+    def _fieldIndex(self, field):
+        try:
+            return self.field_indexes[field]
+        except KeyError:
+            pass
+        valueToPKs, pkToValue = {}, {}
+        for rawRec in self.getAllRaw():
+            value = rawRec.get(field, None)
+            valueToPKs.setdefault(value, set()).add(rawRec['primary_key'])
+            pkToValue[rawRec['primary_key']] = value
+        self.field_indexes[field] = (valueToPKs, pkToValue)
+        return self.field_indexes[field]
+
+    def _reindexFields(self, primaryKey, rawRec):
+        """Move `primaryKey` to its values in `rawRec`, or drop it if None."""
+        for field, (valueToPKs, pkToValue) in self.field_indexes.items():
+            try:
+                oldValue = pkToValue.pop(primaryKey)
+                valueToPKs[oldValue].discard(primaryKey)
+            except KeyError:
+                pass
+            if rawRec is not None:
+                value = rawRec.get(field, None)
+                valueToPKs.setdefault(value, set()).add(primaryKey)
+                pkToValue[primaryKey] = value
+        if self.metadata_index is not None:
+            keyIndex, pkToPairs = self.metadata_index
+            for key, value in pkToPairs.pop(primaryKey, []):
+                keyIndex[key][value].discard(primaryKey)
+            if rawRec is not None:
+                self._indexMetadata(primaryKey, rawRec)
+
+    @staticmethod
+    def _metadataPairs(metadata):
+        """Return the indexed (key, value) pairs of `metadata`.
+
+        Each element of a list value is indexed, values that cannot be
+        hashed are not.
+
+        """
+        metadata = parseMetadata(metadata)
+        if not isinstance(metadata, dict):
+            return []
+        pairs = []
+        for key, value in metadata.items():
+            values = value if isinstance(value, list) else [value]
+            for value in values:
+                try:
+                    hash(value)
+                except TypeError:
+                    continue
+                pairs.append((key, value))
+        return pairs
+
+    def _indexMetadata(self, primaryKey, rawRec):
+        keyIndex, pkToPairs = self.metadata_index
+        pairs = self._metadataPairs(rawRec.get('metadata', None))
+        for key, value in pairs:
+            try:
+                keyIndex[key][value].add(primaryKey)
+            except KeyError:
+                keyIndex.setdefault(key, {}).setdefault(value, set()).add(primaryKey)
+        if pairs:
+            pkToPairs[primaryKey] = pairs
+
+    def _metadataIndex(self):
+        if self.metadata_index is None:
+            self.metadata_index = ({}, {})
+            for rawRec in self.getAllRaw():
+                self._indexMetadata(rawRec['primary_key'], rawRec)
+        return self.metadata_index[0]
+
+    def pksWhereMetadata(self, key, values):
+        """Return the set of primary keys whose metadata `key` is in `values`.
+
+        Uses an inverted index of metadata that is built on first use and
+        then kept in sync by insert, update and remove.
+
+        """
+        valueToPKs = self._metadataIndex().get(key, {})
+        out = set()
+        for value in values:
+            out |= valueToPKs.get(value, set())
+        return out
+
+    def pksWithMetadata(self, criteria):
+        """Return the set of primary keys matching every metadata criterion.
+
+        Args:
+            criteria (dict): Metadata key -> value, e.g.
+                `{'city': 'NYC', 'surface': 'rail'}`.
+
+        """
+        matches = sorted(
+            (self.pksWhereMetadata(key, [value]) for key, value in criteria.items()),
+            key=len
+        )
+        if not matches:
+            return {rawRec['primary_key'] for rawRec in self.getAllRaw()}
+        out = set(matches[0])
+        for match in matches[1:]:
+            out &= match
+        return out
+
+    def getByMetadata(self, criteria):
+        """Return a list of records matching every metadata criterion."""
+        return [self.get(pk) for pk in self.pksWithMetadata(criteria)]
+
+    def pksWhere(self, field, values):
+        """Return the set of primary keys whose `field` is one of `values`.
+
+        Uses an index on `field` that is built on first use and then kept
+        in sync by insert, update and remove.
+
+        """
+        valueToPKs, _ = self._fieldIndex(field)
+        out = set()
+        for value in values:
+            out |= valueToPKs.get(value, set())
+        return out
+
+    def pksOfType(self, types):
+        """Return the set of primary keys of records with one of `types`."""
+        return self.pksWhere(self.typeStored.typeField, types)
+
+    def getByType(self, types):
+        """Return a list of records with one of `types`."""
+        return [self.get(pk) for pk in self.pksOfType(types)]
+
     def getRaw(self, primaryKey):
         """Return the dict backing `primaryKey`"""
-        if not self.pk_index:
+        if self.pk_index is None:
             self._build_pk_index()
-        primaryKey = self.db.asPK(primaryKey)
+        primaryKey = self.asPK(primaryKey)
         ind = self.pk_raw_index[primaryKey]
         return self.getAllRaw()[ind]
 
     def get(self, primaryKey):
-        """Return the record corresponding to `primaryKey`"""
-        if not self.pk_index:
+        """Return the record corresponding to `primaryKey`
+
+        Records are cached so repeated calls return the same object until
+        the record is changed through this table. Changes made to the
+        object without saving it are seen by every caller.
+
+        """
+        if self.pk_index is None:
             self._build_pk_index()
-        primaryKey = self.db.asPK(primaryKey)
+        if primaryKey not in self.pk_raw_index:
+            primaryKey = self.asPK(primaryKey)
+        try:
+            rec = self.recordCache[primaryKey]
+            self.recordCache.move_to_end(primaryKey)
+            return rec
+        except KeyError:
+            pass
         ind = self.pk_raw_index[primaryKey]
         rawRec = self.getAllRaw()[ind]
-        return self.typeStored(self.repo, **rawRec)
+        rec = self.typeStored(self.repo, **rawRec)
+        if self.recordCacheSize > 0:
+            self.recordCache[primaryKey] = rec
+            if len(self.recordCache) > self.recordCacheSize:
+                self.recordCache.popitem(last=False)
+        return rec
+
+    def ordered(self, primaryKeys):
+        """Return a list of `primaryKeys` in the order records are stored."""
+        if self.pk_index is None:
+            self._build_pk_index()
+        return sorted(primaryKeys, key=self.pk_raw_index.__getitem__)
 
     def getMany(self, primaryKeys):
         """Return a list of records corresponding to `priamryKeys`."""
-        primaryKeys = self.db.asPKs(primaryKeys)
+        primaryKeys = self.asPKs(primaryKeys)
         recs = [self.get(pk) for pk in primaryKeys]
         return recs
 
@@ -91,7 +368,7 @@ class DatabaseTable:
 
     def getAll(self):
         """Return a list of all records in the table."""
-        if self.cached_recs:
+        if self.cached_recs is not None:
             return self.cached_recs
         rawRecs = self.getAllRaw()
         self.cached_recs = [self.typeStored(self.repo, **rawRec) for rawRec in rawRecs]
@@ -99,11 +376,31 @@ class DatabaseTable:
 
     def getAllRaw(self):
         """Return a list of all raw records in the table."""
-        if self.cached_raw:
+        if self.cached_raw is not None:
             return self.cached_raw
         self.cached_raw = self.tbl.all()
+        for rawRec in self.cached_raw:
+            self._internKeys(rawRec)
         return self.cached_raw
 
+    def _internKeys(self, rawRec):
+        """Share one string for each primary key and name in `rawRec`.
+
+        Reference lists and dicts are changed in place since backends may
+        share them with their own copy of the record.
+
+        """
+        rawRec['primary_key'] = intern(rawRec['primary_key'])
+        rawRec['name'] = intern(rawRec['name'])
+        for field in self.typeStored.refFields:
+            refs = rawRec.get(field, None)
+            if isinstance(refs, list):
+                refs[:] = [intern(ref) for ref in refs]
+            elif isinstance(refs, dict):
+                for key, ref in refs.items():
+                    if isinstance(ref, str):
+                        refs[key] = intern(ref)
+
     def getAllLazily(self):
         """Return a generator of tuples of name and a record loader."""
         rawRecs = self.getAllRaw()
@@ -125,54 +422,112 @@ class DatabaseTable:
         if not self.db.nameNotUsed(newRecord['name']):
             raise RecordExistsError(newRecord)
 
+        self._trackChange(newRecord['primary_key'], 'insert')
         self.tbl.insert(newRecord)
-        if self.cached_raw:
+        if self.cached_raw is not None:
             self.cached_raw.append(newRecord)
-            if self.pk_raw_index:
+            if self.pk_raw_index is not None:
                 self.pk_raw_index[newRecord['primary_key']] = len(self.cached_raw) - 1
 
-        if self.cached_recs:
-            newRec = self.typeStored(self.repo, **newRecord)
-            self.cached_recs.append(newRec)
-            if self.pk_index:
-                self.pk_index[newRec.primaryKey] = len(self.cached_recs) - 1
+        if self.cached_recs is not None:
+            self.cached_recs.append(self.typeStored(self.repo, **newRecord))
 
-        self.db.nameToPKTable[newRecord['name']] = newRecord['primary_key']
-        self.db.pkToNameTable[newRecord['primary_key']] = newRecord['name']
+        self._indexInserted(newRecord)
 
         return self.get(newRecord['primary_key'])
 
+    def _indexInserted(self, newRecord):
+        self._buildNameTables()
+        self.nameToPK[newRecord['name']] = newRecord['primary_key']
+        self.pkToName[newRecord['primary_key']] = newRecord['name']
+        self.db.nameIndex.logChange(self.tblName,
+                                    newRecord['primary_key'],
+                                    newRecord['name'])
+        self._reindexFields(newRecord['primary_key'], newRecord)
+        self.db.reindexRefs(self.typeStored, newRecord['primary_key'], newRecord)
+
+    def insertMany(self, newRecords):
+        """Add several records to the table. Return their primary keys.
+
+        Names are checked for the whole batch before anything is written
+        and the records are written to the backend in one call. Records
+        are not built, use `get` to build any that are needed.
+
+        """
+        if self.repo.readOnly:
+            raise RepoReadOnlyError()
+        batchNames, batchPKs = set(), {}
+        for newRecord in newRecords:
+            assert newRecord['primary_key'] is None
+            name = newRecord['name']
+            if name in batchNames or not self.db.nameNotUsed(name):
+                raise RecordExistsError(newRecord)
+            batchNames.add(name)
+            pk = self._newPrimaryKey()
+            if pk in batchPKs or not self.db.pkNotUsed(pk):
+                raise RecordExistsError(newRecord)
+            batchPKs[pk] = newRecord
+        for pk, newRecord in batchPKs.items():
+            newRecord['primary_key'] = pk
+            self._trackChange(pk, 'insert')
+
+        self.tbl.insertMany(newRecords)
+        if self.cached_raw is not None:
+            offset = len(self.cached_raw)
+            self.cached_raw.extend(newRecords)
+            if self.pk_raw_index is not None:
+                for ind, newRecord in enumerate(newRecords):
+                    self.pk_raw_index[newRecord['primary_key']] = offset + ind
+        # building records is what a bulk insert avoids, so rather than
+        # extending the cached records they are rebuilt by the next getAll
+        self.cached_recs = None
+
+        for newRecord in newRecords:
+            self._indexInserted(newRecord)
+        return [newRecord['primary_key'] for newRecord in newRecords]
+
     def update(self, primaryKey, updatedRecord):
         """Change `primaryKey` to updatedRecord. Return the new record."""
-        primaryKey = self.db.asPK(primaryKey)
+        primaryKey = self.asPK(primaryKey)
         if self.repo.readOnly:
             raise RepoReadOnlyError
+        self._trackChange(primaryKey, 'update')
+        self.recordCache.pop(primaryKey, None)
         rawRec = self.getRaw(primaryKey)
         assert rawRec['name'] == updatedRecord['name']
-        self.tbl.update(updatedRecord, where('primary_key') == primaryKey)
+        self.tbl.update(primaryKey, updatedRecord)
+        rawRec.update(updatedRecord)
+        self._reindexFields(primaryKey, rawRec)
+        self.db.reindexRefs(self.typeStored, primaryKey, rawRec)
         return self.get(primaryKey)
 
     def remove(self, primaryKey):
         """Remove `primaryKey` from the table."""
-        primaryKey = self.db.asPK(primaryKey)
+        primaryKey = self.asPK(primaryKey)
         if self.repo.readOnly:
             raise RepoReadOnlyError
 
-        if not self.pk_index:
+        if self.pk_index is None:
             self._build_pk_index()
 
-        self.tbl.remove(where('primary_key') == primaryKey)
-
-        try:
-            rec_ind = self.pk_index[primaryKey]
-            del self.cached_recs[rec_ind]
-            raw_ind = self.pk_raw_index[primaryKey]
-            del self.cached_raw[raw_ind]
-        except TypeError:
-            pass
-
-        self.pk_index = None
-        self.pk_raw_index = None
+        self._trackChange(primaryKey, 'remove')
+        self.recordCache.pop(primaryKey, None)
+        self.tbl.remove(primaryKey)
+
+        # move the last record into the hole so only one index changes
+        ind = self.pk_raw_index.pop(primaryKey)
+        for cached in (self.cached_raw, self.cached_recs):
+            if cached is not None:
+                cached[ind] = cached[-1]
+                cached.pop()
+        if ind < len(self.cached_raw):
+            self.pk_raw_index[self.cached_raw[ind]['primary_key']] = ind
+
+        if self.nameToPK is not None:
+            del self.nameToPK[self.pkToName.pop(primaryKey)]
+            self.db.nameIndex.logChange(self.tblName, primaryKey, None)
+        self._reindexFields(primaryKey, None)
+        self.db.reindexRefs(self.typeStored, primaryKey, None)
 
     def getInvalids(self):
         """Return a list of primary keys for records that cannot be built."""
@@ -205,19 +560,13 @@ class DatabaseTable:
                 toRemove.append(rawRec['primary_key'])
 
         for pk in toRemove:
-            self.tbl.remove(where('primary_key') == pk)
+            self.remove(pk)
 
     def checkStatus(self):
-        """Return a map of record names to valid status."""
-        out = {}
-        for name, recfunc in self.getAllLazily():
-            try:
-                rec = recfunc()
-            except InvalidRecordStateError as irse:
-                out[name] = (False, 'could_not_instantiate_record:' + str(irse))
-                continue
-            try:
-                out[name] = rec.detailedStatus()
-            except InvalidRecordStateError as irse:
-                out[name] = (False, 'could_not_check_status:' + str(irse))
-        return out
+        """Return a map of record names to valid status.
+
+        Records of the tables this one references are evaluated once each
+        in the same pass, see `StatusCache`.
+
+        """
+        return StatusCache(self.db).tableStatus(self)
@@ -0,0 +1,44 @@
+import os
+
+from .checksums import mapInPool
+
+# directories holding fewer of the checked files are not listed, a stat of
+# each file is cheaper than listing a large directory
+MIN_LISTED = 4
+
+
+def existingFiles(filepaths, workers=None):
+    '''Return the set of `filepaths` that are files.
+
+    Paths are grouped by directory and each directory is listed once with
+    `os.scandir`, directories are checked concurrently. Gives the same
+    answer as `os.path.isfile` for each path.
+
+    Args:
+        filepaths (list): Absolute paths of files.
+        workers (:obj:`int`, optional): The number of directories checked
+            at once. Defaults to `checksums.DEFAULT_WORKERS`.
+
+    '''
+    byDir = {}
+    for filepath in filepaths:
+        byDir.setdefault(os.path.dirname(filepath), []).append(filepath)
+
+    def check(item):
+        dirpath, paths = item
+        if len(paths) < MIN_LISTED:
+            return [p for p in paths if os.path.isfile(p)]
+        try:
+            with os.scandir(dirpath) as entries:
+                # is_file only needs a stat for symlinks
+                names = {entry.name for entry in entries if entry.is_file()}
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        except OSError:
+            return [p for p in paths if os.path.isfile(p)]
+        return [p for p in paths if os.path.basename(p) in names]
+
+    out = set()
+    for found in mapInPool(check, byDir.items(), workers=workers):
+        out.update(found)
+    return out
@@ -1,22 +1,34 @@
 from .base_record import BaseRecord
-import hashlib
 from os import rename, path, makedirs
 from shutil import copy2
+from .checksums import (
+    DEFAULT_ALGORITHM,
+    HashReport,
+    headChecksum,
+    mapInPool,
+    parseChecksum,
+)
 
 
 class FileRecord(BaseRecord):
     '''Class that keeps track of an actual file.'''
+    __slots__ = ('_filepath', 'fileType', 'checksum', 'cachedValid',
+                 'cachedMsg')
+    typeField = 'file_type'
+    # algorithm of full checksums unless another is asked for
+    checksumAlgorithm = DEFAULT_ALGORITHM
 
     def __init__(self, repo, **kwargs):
         super(FileRecord, self).__init__(repo, **kwargs)
 
         self._filepath = self.repo.pathFromRepo(kwargs['filepath'])
         self.fileType = self.repo.validateFileType(kwargs['file_type'])
-        self.cached_current_checksum = None
         try:
             self.checksum = kwargs['checksum']
         except KeyError:
-            self.checksum = self._currentChecksum()
+            # hashing whole files here would read every byte of every file
+            # added, full checksums are filled in by `verify --upgrade`
+            self.checksum = headChecksum(self.filepath())
         self.cachedValid = None
         self.cachedMsg = None
 
@@ -38,30 +50,76 @@ class FileRecord(BaseRecord):
         '''Return the abspath of the actual file.'''
         return self.repo.toAbspath(self._filepath)
 
-    def _currentChecksum(self):
-        if self.cached_current_checksum:
-            return self.cached_current_checksum
-        bits = open(self.filepath(), 'rb').read(4096)
-        self.cached_current_checksum = hashlib.sha256(bits).hexdigest()
-        return self.cached_current_checksum
+    def fullChecksum(self, algorithm=None, report=None):
+        '''Return the checksum of the whole file.
+
+        Files that have not changed since they were last hashed are looked
+        up in the checksum cache of the database instead.
+
+        Args:
+            algorithm (:obj:`str`, optional): One of `checksums.ALGORITHMS`.
+                Defaults to `checksumAlgorithm`.
+            report (:obj:`HashReport`, optional): Counts the bytes hashed.
+
+        '''
+        if algorithm is None:
+            algorithm = self.checksumAlgorithm
+        return self.db.checksumCache.checksum(self.filepath(), algorithm,
+                                              report=report)
+
+    def verify(self, report=None):
+        '''Hash the file and compare it to the stored checksum.
+
+        Checksums stored when a file is added only cover its first 4096
+        bytes, use `fullChecksum` to replace them.
+
+        Returns:
+            A tuple of True or False and a message.
+
+        '''
+        try:
+            algorithm, _ = parseChecksum(self.checksum)
+            if algorithm is None:
+                current = headChecksum(self.filepath())
+                if report is not None:
+                    report.add(min(4096, path.getsize(self.filepath())))
+            else:
+                current = self.fullChecksum(algorithm, report=report)
+        except FileNotFoundError:
+            return False, 'file_not_found' + ':' + self.filepath()
+        except OSError as oserror:
+            return False, 'unreadable' + ':' + str(oserror)
+        if current != self.checksum:
+            return False, 'bad_checksum' + ':' + self.filepath()
+        return True, 'all_good'
+
+    @classmethod
+    def verifyMany(cls, fileRecords, workers=None):
+        '''Verify several file records with a pool of threads.
+
+        Args:
+            fileRecords (list): The file records to verify.
+            workers (:obj:`int`, optional): The number of files hashed at
+                once. Defaults to `checksums.DEFAULT_WORKERS`.
+
+        Returns:
+            A dict of record name -> (True or False, message) and the
+            `HashReport` of the files hashed.
+
+        '''
+        report = HashReport()
+        fileRecords = list(fileRecords)
+        statuses = mapInPool(lambda rec: rec.verify(report=report),
+                             fileRecords, workers=workers)
+        out = {rec.name: status for rec, status in zip(fileRecords, statuses)}
+        if fileRecords:
+            fileRecords[0].db.checksumCache.save()
+        return out, report.finish()
 
     def _validStatus(self):
         return self._detailedStatus()[0]
 
     def _detailedStatus(self):
-        '''
-        msg = 'all_good'
-        if self.cachedValid is None:
-            try:
-                self.cachedValid = self.checksum == self._currentChecksum()
-                if not self.cachedValid:
-                    msg = 'bad_checksum' + ':' + self.filepath()
-                self.cachedMsg = msg
-            except FileNotFoundError:
-                self.cachedValid = False
-                self.cachedMsg = 'file_not_found' + ':' + self.filepath()
-        return self.cachedValid, self.cachedMsg
-        '''
         if self.cachedValid is not None:
             return self.cachedValid, self.cachedMsg
         if not path.isfile(self.filepath()):
@@ -72,6 +130,13 @@ class FileRecord(BaseRecord):
             self.cachedMsg = 'all_good'
         return self.cachedValid, self.cachedMsg
 
+    @staticmethod
+    def existenceStatus(filepath, exists):
+        '''Return the status of a file record whose file is `filepath`.'''
+        if exists:
+            return True, 'all_good'
+        return False, 'file_not_found' + ':' + filepath
+
     def __str__(self):
         out = '{}\t{}'.format(self.name, self.filepath())
         return out
@@ -0,0 +1,144 @@
+import json
+import os
+from sys import intern
+
+from .concurrency import RepoLock
+
+
+class NameIndex:
+    '''Persists the name tables of every table next to the database.
+
+    The index file starts with a snapshot of the primary key -> name map
+    of each table. Changes made by `DatabaseTable.insert`, `rename` and
+    `remove` are appended as single lines when the database is flushed,
+    followed by the generation of the database the index now matches. An
+    index whose last generation does not match the database is rebuilt.
+    Every write to the index is made while holding the repo lock.
+
+    '''
+    fileName = 'datasuper.names.jsonl'
+    compactThreshold = 1000
+
+    def __init__(self, db):
+        self.db = db
+        self.path = os.path.join(db.repo.abspath, NameIndex.fileName)
+        self.tables = None
+        self.pending = []
+        self.nChanges = 0
+        self.generation = None
+
+    def _load(self):
+        if self.tables is not None:
+            return
+        try:
+            with open(self.path) as indexFile:
+                lines = indexFile.read().splitlines()
+            tables = json.loads(lines[0])
+            generation = None
+            for line in lines[1:]:
+                change = json.loads(line)
+                if 'generation' in change:
+                    generation = change['generation']
+                    continue
+                generation = None
+                tbl = tables.setdefault(change['table'], {})
+                if change['name'] is None:
+                    tbl.pop(change['primary_key'], None)
+                else:
+                    tbl[change['primary_key']] = change['name']
+        except (OSError, IndexError, ValueError):
+            self._rebuild()
+            return
+        if generation != self.db.backend.generation():
+            self._rebuild()
+            return
+        self.tables = {
+            tblName: {intern(pk): intern(name) for pk, name in tbl.items()}
+            for tblName, tbl in tables.items()
+        }
+        self.nChanges = len(lines) - 1
+        self.generation = generation
+
+    def _rebuild(self):
+        self.tables = {}
+        for tbl in self.db.tables():
+            self.tables[tbl.tblName] = {
+                intern(pk): intern(name) for pk, name in tbl.tbl.names()
+            }
+        # the names are those of the database as the backend read it
+        self.generation = self.db.backend.readGeneration
+        try:
+            with RepoLock(self.db.repo.abspath):
+                self._writeSnapshot(self.generation)
+        except OSError:
+            pass  # the repo may not be writable, the index is just not saved
+
+    def _writeSnapshot(self, generation):
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as indexFile:
+            indexFile.write(json.dumps(self.tables) + '\n')
+            indexFile.write(json.dumps({'generation': generation}) + '\n')
+        os.replace(tmpPath, self.path)
+        self.generation = generation
+        self.nChanges = 1
+        self.pending = []
+
+    def invalidate(self):
+        '''Remove the saved index, the next database to load it rebuilds it.'''
+        self.generation = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def pkToName(self, tblName):
+        '''Return the primary key -> name map of `tblName`.
+
+        The map is shared with the caller, changes to it must be recorded
+        with `logChange`.
+
+        '''
+        self._load()
+        try:
+            return self.tables[tblName]
+        except KeyError:
+            tbl = [tbl for tbl in self.db.tables() if tbl.tblName == tblName][0]
+            self.tables[tblName] = dict(tbl.tbl.names())
+            self.nChanges = self.compactThreshold  # snapshot on next flush
+            return self.tables[tblName]
+
+    def logChange(self, tblName, primaryKey, name):
+        '''Record that `primaryKey` now has `name`, or was removed if None.'''
+        self.pending.append({
+            'table': tblName,
+            'primary_key': primaryKey,
+            'name': name,
+        })
+
+    def flush(self):
+        '''Save changes to the index so it matches the flushed database.
+
+        Must be called with the repo lock held, after the backend wrote its
+        changes and before its `readGeneration` is updated. Changes are
+        only added to an index read from the database they were made to,
+        any other index is invalidated.
+
+        '''
+        if self.tables is None:
+            return
+        if self.generation != self.db.backend.readGeneration:
+            self.invalidate()
+            return
+        generation = self.db.backend.generation()
+        if not self.pending and generation == self.generation:
+            return
+        if self.nChanges + len(self.pending) > self.compactThreshold:
+            self._writeSnapshot(generation)
+            return
+        self.pending.append({'generation': generation})
+        lines = ''.join([json.dumps(change) + '\n' for change in self.pending])
+        with open(self.path, 'a') as indexFile:
+            indexFile.write(lines)
+        self.nChanges += len(self.pending)
+        self.pending = []
+        self.generation = generation
@@ -0,0 +1,189 @@
+from .file_record import FileRecord
+from .result import ResultRecord
+from .sample import SampleRecord
+from .sample_group import SampleGroupRecord
+
+
+def _asValues(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+class Query:
+    '''Finds records of one type that match a set of conditions.
+
+    Queries are built by chaining, each call returns a new query::
+
+        repo.query(ResultRecord).where(result_type='x',
+                                       metadata__city='NYC').inGroup('g1')
+
+    Conditions are answered from the table indexes where one exists, the
+    primary key, name, type, reference and metadata indexes. Other fields
+    are checked against the raw records of the remaining candidates, or
+    of the whole table if no condition could use an index. Records are
+    only built when the query is iterated.
+
+    '''
+
+    def __init__(self, db, recType, conditions=(), groups=()):
+        self.db = db
+        self.recType = recType
+        self.table = db.getTable(recType)
+        self.conditions = tuple(conditions)
+        self.groups = tuple(groups)
+
+    def where(self, **conditions):
+        '''Return a query that also matches every condition.
+
+        Each keyword is a stored field (e.g. `name`, `result_type` or
+        `results`) or `metadata__<key>`, each value a value or a list of
+        values any of which may match.
+
+        '''
+        added = [(field, _asValues(value)) for field, value in conditions.items()]
+        return Query(self.db, self.recType, self.conditions + tuple(added),
+                     self.groups)
+
+    def inGroup(self, *groups):
+        '''Return a query that also requires records to be in one of `groups`.
+
+        A record is in a group if it is in the group, a subgroup, or is
+        referenced by a record that is, e.g. the files of a result of a
+        sample of the group.
+
+        '''
+        return Query(self.db, self.recType, self.conditions,
+                     self.groups + (groups,))
+
+    def _groupMembers(self, groups):
+        groupTbl = self.db.sampleGroupTable
+        rootPKs = groupTbl.asPKs(groups)
+        subgroupPKs, stack = set(), list(rootPKs)
+        while stack:
+            rawGroup = groupTbl.getRaw(stack.pop())
+            for subgroup in groupTbl.asPKs(rawGroup.get('subgroups', [])):
+                if subgroup not in subgroupPKs:
+                    subgroupPKs.add(subgroup)
+                    stack.append(subgroup)
+        if self.recType == SampleGroupRecord:
+            return subgroupPKs
+
+        rawGroups = [groupTbl.getRaw(pk) for pk in rootPKs | subgroupPKs]
+        samplePKs = set()
+        for rawGroup in rawGroups:
+            samplePKs |= self.db.sampleTable.asPKs(rawGroup.get('direct_samples', []))
+        if self.recType == SampleRecord:
+            return samplePKs
+
+        resultPKs = set()
+        for rawGroup in rawGroups:
+            resultPKs |= self.db.resultTable.asPKs(rawGroup.get('direct_results', []))
+        for samplePK in samplePKs:
+            rawSample = self.db.sampleTable.getRaw(samplePK)
+            resultPKs |= self.db.resultTable.asPKs(rawSample.get('results', []))
+        if self.recType == ResultRecord:
+            return resultPKs
+
+        filePKs = set()
+        for resultPK in resultPKs:
+            fileRecs = self.db.resultTable.getRaw(resultPK)['file_records']
+            if isinstance(fileRecs, dict):
+                fileRecs = fileRecs.values()
+            filePKs |= self.db.fileTable.asPKs(
+                [ref for ref in fileRecs if ref is not None]
+            )
+        if self.recType == FileRecord:
+            return filePKs
+
+    def _indexedPKs(self, field, values):
+        '''Return the primary keys matching a condition, or None if the
+        condition has no index.
+        '''
+        tbl = self.table
+        if field == 'name' or field == 'primary_key':
+            pks = set()
+            for value in values:
+                try:
+                    pks.add(tbl.asPK(value))
+                except (KeyError, TypeError):
+                    pass
+            return pks
+        if field == self.recType.typeField:
+            return tbl.pksWhere(field, values)
+        if field in self.recType.refFields:
+            pks = set()
+            for value in values:
+                try:
+                    pks |= self.db.referrers(value, fields=[field])
+                except KeyError:
+                    pass
+            return {pk for pk in pks if tbl.hasPK(pk)}
+        if field.startswith('metadata__'):
+            return tbl.pksWhereMetadata(field[len('metadata__'):], values)
+        return None
+
+    def _plan(self):
+        '''Return the candidate primary keys, or None for every record,
+        and the conditions that must be checked on raw records.
+        '''
+        matches, scans = [], []
+        for field, values in self.conditions:
+            pks = self._indexedPKs(field, values)
+            if pks is None:
+                scans.append((field, values))
+            else:
+                matches.append(pks)
+        for groups in self.groups:
+            matches.append(self._groupMembers(groups))
+        if not matches:
+            return None, scans
+        matches.sort(key=len)
+        candidates = set(matches[0])
+        for match in matches[1:]:
+            candidates &= match
+        return candidates, scans
+
+    def _rawRecords(self, candidates, scans):
+        if candidates is None:
+            rawRecs = self.table.getAllRaw()
+        else:
+            rawRecs = (
+                self.table.getRaw(pk) for pk in self.table.ordered(candidates)
+            )
+        for rawRec in rawRecs:
+            if all(rawRec.get(field, None) in values for field, values in scans):
+                yield rawRec
+
+    def pks(self):
+        '''Return an iterator over the primary keys of matching records.'''
+        candidates, scans = self._plan()
+        if candidates is not None and not scans:
+            return iter(self.table.ordered(candidates))
+        return (
+            rawRec['primary_key']
+            for rawRec in self._rawRecords(candidates, scans)
+        )
+
+    def count(self):
+        '''Return the number of matching records, without building them.'''
+        candidates, scans = self._plan()
+        if candidates is not None and not scans:
+            return len(candidates)
+        return sum(1 for _ in self._rawRecords(candidates, scans))
+
+    def exists(self):
+        '''Return True if any record matches, without building records.'''
+        for _ in self.pks():
+            return True
+        return False
+
+    def first(self):
+        '''Return the first matching record or None.'''
+        for record in self:
+            return record
+        return None
+
+    def __iter__(self):
+        for pk in self.pks():
+            yield self.table.get(pk)
@@ -1,3 +1,4 @@
+from collections.abc import Mapping
 from .base_record import BaseRecord
 from pyarchy import archy
 from .database_exceptions import (
@@ -8,38 +9,65 @@ from .database_exceptions import (
 
 class ResultRecord(BaseRecord):
     '''Class that keeps track of a result, essentially a set of files.'''
+    __slots__ = ('_storedPreviousResults', '_previousResultPKs', '_provenance',
+                 '_resultType', '_storedFileRecords', '_fileRecordPKs')
+    typeField = 'result_type'
+    refFields = ['file_records']
 
     def __init__(self, repo, **kwargs):
         super(ResultRecord, self).__init__(repo, **kwargs)
+        # references are kept as stored and resolved when first used
         try:
-            self._previousResults = self.db.asPKs(kwargs['previous_results'])
+            self._storedPreviousResults = kwargs['previous_results']
         except KeyError:
-            self._previousResults = []
+            self._storedPreviousResults = []
+        self._previousResultPKs = None
 
         try:
             self._provenance = kwargs['provenance']
         except KeyError:
             self._provenance = []
         self._resultType = self.repo.validateResultType(kwargs['result_type'])
-        self._resultSchema = self.repo.getResultSchema(self._resultType)
 
         try:
-            fileRecs = kwargs['file_records']
-            try:
-                fileRecs = {k: self.db.asPK(v) for k, v in fileRecs.items()}
-            except AttributeError:
-                fileRecs = [self.db.asPK(el) for el in fileRecs]
+            self._storedFileRecords = kwargs['file_records']
         except KeyError:
             raise InvalidRecordStateError('missing_one_or_more_files')
-
-        # this will return a list of primary keys or a
-        # map of identifiers -> primary keys (as a dict)
-        self._fileRecords = self.instantiateResultSchema(fileRecs)
+        self._fileRecordPKs = None
+
+    @property
+    def _previousResults(self):
+        if self._previousResultPKs is None:
+            self._previousResultPKs = self.db.resultTable.asPKs(
+                self._storedPreviousResults
+            )
+        return self._previousResultPKs
+
+    @property
+    def _fileRecords(self):
+        if self._fileRecordPKs is None:
+            fileRecs = self._storedFileRecords
+            try:
+                try:
+                    fileRecs = {k: self.db.fileTable.asPK(v)
+                                for k, v in fileRecs.items()}
+                except AttributeError:
+                    fileRecs = [self.db.fileTable.asPK(el) for el in fileRecs]
+            except KeyError:
+                raise InvalidRecordStateError('Could not convert key to file record')
+            # this will return a list of primary keys or a
+            # map of identifiers -> primary keys (as a dict)
+            self._fileRecordPKs = self.instantiateResultSchema(fileRecs)
+        return self._fileRecordPKs
+
+    @property
+    def _resultSchema(self):
+        return self.repo.getResultSchema(self._resultType)
 
     def to_dict(self):
         '''Create a dict that serializes this result.'''
         out = super(ResultRecord, self).to_dict()
-        out['previous_results'] = self._previousResults
+        out['previous_results'] = sorted(self._previousResults)
         out['provenance'] = self._provenance
         out['file_records'] = self._fileRecords
         out['result_type'] = self._resultType
@@ -47,13 +75,17 @@ class ResultRecord(BaseRecord):
 
     def files(self):
         '''Return a list of tuples of (key, file-record).'''
-        if isinstance(self._fileRecords, dict):
-            out = {}
-            for k, fr in self._fileRecords.items():
-                out[k] = self.db.fileTable.get(fr)
-            tups = out.items()
-        else:
-            tups = enumerate(self.db.fileTable.getMany(self._fileRecords))
+        try:
+            if isinstance(self._fileRecords, dict):
+                out = {}
+                for k, fr in self._fileRecords.items():
+                    out[k] = self.db.fileTable.get(fr)
+                tups = out.items()
+            else:
+                tups = enumerate(self.db.fileTable.getMany(self._fileRecords))
+        except KeyError:
+            # the file record was removed after this result resolved it
+            raise InvalidRecordStateError('Could not convert key to file record')
         return [(k, v) for k, v in tups]
 
     def _validStatus(self):
@@ -84,7 +116,7 @@ class ResultRecord(BaseRecord):
 
     def instantiateResultSchema(self, fileRecs, aggressive=False):
         schema = self.repo.getResultSchema(self.resultType())
-        if isinstance(schema, list):
+        if isinstance(schema, tuple):
             if fileRecs is None:
                 return [None for _ in schema]
             if len(fileRecs) != len(schema):
@@ -93,7 +125,7 @@ class ResultRecord(BaseRecord):
                                                        schema,
                                                        fileRecs)
             return fileRecs
-        elif isinstance(schema, dict):
+        elif isinstance(schema, Mapping):
             if fileRecs is None:
                 return {k: None for k in schema.keys()}
             else:
@@ -118,8 +150,11 @@ class ResultRecord(BaseRecord):
     def tree(self, raw=False):
         '''Returns a JSONable tree starting at this result.'''
         out = {'label': self.name, 'nodes': []}
-        for key, fr in self.files():
-            out['nodes'].append('{} {}'.format(key, str(fr)))
+        try:
+            for key, fr in self.files():
+                out['nodes'].append('{} {}'.format(key, str(fr)))
+        except InvalidRecordStateError as irse:
+            out['nodes'].append('invalid: {}'.format(irse))
         if raw:
             return out
         return archy(out)
@@ -127,20 +162,25 @@ class ResultRecord(BaseRecord):
     def remove(self, atomic=False):
         '''Remove this result.
 
-        Rewrite this method. Currently removing the record breaks the
-        db which should not happen. Not clear if removing the record should
-        remove files (if not atomic) but that seems intuitive.
+        Unless `atomic` is set the result is also dropped from the samples
+        and groups that reference it, and its files are removed if no
+        other result uses them.
 
         '''
-        if not atomic:
-            pk = self.primaryKey
-            samples = self.db.sampleTable.getAll()
-            for sample in samples:
-                try:
-                    sample.dropResult(pk)
-                except KeyError:
-                    # the sample did not have this result
-                    pass
-            for name, f in self.files():
-                f.atomicDelete()
+        if atomic:
+            self.atomicDelete()
+            return
+        pk = self.primaryKey
+        referencing = [
+            (self.db.sampleTable, 'results'),
+            (self.db.sampleGroupTable, 'direct_results'),
+        ]
+        for tbl, field in referencing:
+            for referrer in self.db.referrers(pk, fields=[field]):
+                rawRec = dict(tbl.getRaw(referrer))
+                rawRec[field] = [el for el in rawRec[field] if el != pk]
+                tbl.update(referrer, rawRec)
         self.atomicDelete()
+        for name, f in self.files():
+            if self.db.isOrphan(f.primaryKey):
+                f.atomicDelete()
@@ -1,28 +1,39 @@
 from .base_record import BaseRecord
 from pyarchy import archy
 from .result import ResultRecord
+from .database_exceptions import InvalidRecordStateError
 
 
 class SampleRecord(BaseRecord):
     '''Class that keeps track of a sample, essentially a set of results.'''
+    __slots__ = ('_storedResults', '_resultPKs', 'sampleType')
+    typeField = 'sample_type'
+    refFields = ['results']
 
     def __init__(self, repo, **kwargs):
         super(SampleRecord, self).__init__(repo, **kwargs)
+        # results are kept as stored and resolved when first used
         try:
-            _results = kwargs['results']
+            self._storedResults = kwargs['results']
         except KeyError:
-            _results = []
-        try:
-            self._results = self.db.asPKs(_results)
-        except KeyError:
-            raise InvalidRecordStateError('Could not convert key to result')
-        # n.b. these are keys not objects
+            self._storedResults = []
+        self._resultPKs = None
         self.sampleType = self.repo.validateSampleType(kwargs['sample_type'])
 
+    @property
+    def _results(self):
+        # n.b. these are keys not objects
+        if self._resultPKs is None:
+            try:
+                self._resultPKs = self.db.resultTable.asPKs(self._storedResults)
+            except KeyError:
+                raise InvalidRecordStateError('Could not convert key to result')
+        return self._resultPKs
+
     def to_dict(self):
         '''Create a dict that serializes this sample.'''
         out = super(SampleRecord, self).to_dict()
-        out['results'] = self._results
+        out['results'] = sorted(self._results)
         out['sample_type'] = str(self.sampleType)
         return out
 
@@ -46,7 +57,7 @@ class SampleRecord(BaseRecord):
         '''Add a result to this sample. Return this sample.'''
         if issubclass(type(result), BaseRecord):
             result = result.primaryKey
-        result = self.db.asPK(result)
+        result = self.db.resultTable.asPK(result)
         self._results.add(result)
         return self
 
@@ -54,21 +65,15 @@ class SampleRecord(BaseRecord):
         '''Remove a result from this sample but do not commit to disk.'''
         if issubclass(type(result), BaseRecord):
             result = result.primaryKey
-        result = self.db.asPK(result)
+        result = self.db.resultTable.asPK(result)
         self._results.remove(result)
 
     def results(self, resultTypes=None):
         '''Return a list of results in this sample.'''
-        results = self.db.resultTable.getMany(self._results)
+        resultPKs = self._results
         if resultTypes is not None:
-            filtered = []
-            rTypes = {rtype for rtype in resultTypes}
-            for result in results:
-                if result.resultType() in rTypes:
-                    filtered.append(result)
-            results = filtered
-
-        return results
+            resultPKs = resultPKs & self.db.resultTable.pksOfType(resultTypes)
+        return self.db.resultTable.getMany(resultPKs)
 
     def __str__(self):
         out = '{}\t{}'.format(self.name, self.sampleType)
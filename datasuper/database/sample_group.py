@@ -6,23 +6,33 @@ from pyarchy import archy
 
 class SampleGroupRecord(BaseRecord):
     '''Class that tracks a group, a set of groups, samples, and results.'''
+    __slots__ = ('_storedRefs', '_refPKs')
+    refFields = ['subgroups', 'direct_samples', 'direct_results']
 
     def __init__(self, repo, **kwargs):
         super(SampleGroupRecord, self).__init__(repo, **kwargs)
-        try:
-            self._subgroups = self.db.asPKs(kwargs['subgroups'])
-        except KeyError:
-            self._subgroups = []
+        # references are kept as stored and resolved when first used
+        self._storedRefs = {field: kwargs.get(field, []) for field in self.refFields}
+        self._refPKs = {}
 
+    def _refs(self, field, tbl):
         try:
-            self._directSamples = self.db.asPKs(kwargs['direct_samples'])
+            return self._refPKs[field]
         except KeyError:
-            self._directSamples = []
+            self._refPKs[field] = tbl.asPKs(self._storedRefs[field])
+            return self._refPKs[field]
 
-        try:
-            self._directResults = self.db.asPKs(kwargs['direct_results'])
-        except KeyError:
-            self._directResults = []
+    @property
+    def _subgroups(self):
+        return self._refs('subgroups', self.dbTable)
+
+    @property
+    def _directSamples(self):
+        return self._refs('direct_samples', self.db.sampleTable)
+
+    @property
+    def _directResults(self):
+        return self._refs('direct_results', self.db.resultTable)
 
     def _validStatus(self):
         return self._validStatus()[0]
@@ -53,23 +63,23 @@ class SampleGroupRecord(BaseRecord):
     def to_dict(self):
         '''Return a dict that serializes this sample.'''
         out = super(SampleGroupRecord, self).to_dict()
-        out['subgroups'] = self._subgroups
-        out['direct_samples'] = self._directSamples
-        out['direct_results'] = self._directResults
+        out['subgroups'] = sorted(self._subgroups)
+        out['direct_samples'] = sorted(self._directSamples)
+        out['direct_results'] = sorted(self._directResults)
         return out
 
     def addSample(self, sample):
         '''Add a sample to this group.'''
         if issubclass(type(sample), BaseRecord):
             sample = sample.primaryKey
-        sample = self.db.asPK(sample)
+        sample = self.db.sampleTable.asPK(sample)
         self._directSamples.add(sample)
 
     def addResult(self, result):
         '''Add a result to this group.'''
         if issubclass(type(result), BaseRecord):
             result = result.primaryKey
-        result = self.db.asPK(result)
+        result = self.db.resultTable.asPK(result)
         self._directResults.add(result)
 
     def directSamples(self):
@@ -88,26 +98,21 @@ class SampleGroupRecord(BaseRecord):
         '''Return a list of results directly attached to this group.'''
         return self.db.resultTable.getMany(self._directResults)
 
-    def allResults(self, resultTypes=None):
-        '''Return a list of results from this group or from subgroups.'''
-        results = []
-        for res in self.directResults():
-            results.append(res)
+    def _allResultPKs(self):
+        resultPKs = list(self._directResults)
         for sample in self.directSamples():
-            for res in sample.results():
-                results.append(res)
+            resultPKs += list(sample._results)
         for subgroup in self.subgroups():
-            for res in subgroup.allResults():
-                results.append(res)
+            resultPKs += subgroup._allResultPKs()
+        return resultPKs
 
+    def allResults(self, resultTypes=None):
+        '''Return a list of results from this group or from subgroups.'''
+        resultPKs = self._allResultPKs()
         if resultTypes is not None:
-            filtered = []
-            rTypes = {rtype for rtype in resultTypes}
-            for result in results:
-                if result.resultType() in rTypes:
-                    filtered.append(result)
-            results = filtered
-        return results
+            typed = self.db.resultTable.pksOfType(resultTypes)
+            resultPKs = [pk for pk in resultPKs if pk in typed]
+        return [self.db.resultTable.get(pk) for pk in resultPKs]
 
     def subgroups(self):
         '''Return a list of subgroups attached to this group.'''
@@ -0,0 +1,76 @@
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONSerializer:
+    '''Reads and writes JSON, with ujson when it is installed.
+
+    The output of both codecs is plain JSON so files written with one can
+    be read with the other.
+
+    '''
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def dumps(data):
+        '''Return `data` as a JSON string.'''
+        if ujson is not None:
+            try:
+                return ujson.dumps(data, escape_forward_slashes=False)
+            except OverflowError:
+                pass  # integers too big for ujson
+        return json.dumps(data)
+
+    @staticmethod
+    def loads(serialized):
+        '''Return the data in the JSON string `serialized`.'''
+        if ujson is not None:
+            try:
+                return ujson.loads(serialized)
+            except OverflowError:
+                pass
+        return json.loads(serialized)
+
+
+class MsgpackSerializer:
+    '''Reads and writes the binary msgpack format.
+
+    Requires the msgpack package, `pip install datasuper[msgpack]`.
+
+    '''
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def _require():
+        if msgpack is None:
+            raise ImportError('the msgpack package is needed to use msgpack '
+                              'databases, install it with pip')
+
+    @staticmethod
+    def dumps(data):
+        '''Return `data` as msgpack bytes.'''
+        MsgpackSerializer._require()
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def loads(serialized):
+        '''Return the data in the msgpack bytes `serialized`.'''
+        MsgpackSerializer._require()
+        return msgpack.unpackb(serialized, raw=False)
+
+
+SERIALIZERS = {
+    JSONSerializer.name: JSONSerializer,
+    MsgpackSerializer.name: MsgpackSerializer,
+}
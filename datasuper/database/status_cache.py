@@ -0,0 +1,372 @@
+import hashlib
+import os
+import time
+
+from .checksum_cache import statSignature
+from .checksums import mapInPool
+from .database_exceptions import InvalidRecordStateError
+from .file_checks import existingFiles
+from .file_record import FileRecord
+from .serializers import JSONSerializer
+
+# directories changed this recently may change again within the same mtime
+# tick, their files are checked again by the next incremental status
+RECENT_NS = 2 * 10**9
+
+
+def recordVersion(rawRec):
+    '''Return a digest that changes whenever the stored record changes.'''
+    serialized = JSONSerializer.dumps(rawRec).encode('utf-8')
+    return hashlib.blake2b(serialized, digest_size=12).hexdigest()
+
+
+def directorySignature(dirpath):
+    '''Return a string that changes when files are added to, removed from
+    or renamed in `dirpath`, or None if it cannot be trusted.
+    '''
+    try:
+        signature = statSignature(dirpath)
+    except (FileNotFoundError, NotADirectoryError):
+        return 'missing'
+    except OSError:
+        return None
+    if time.time_ns() - signature[3] < RECENT_NS:
+        return None
+    return ':'.join(str(el) for el in signature)
+
+
+def _stored(version):
+    return version.partition('@')[0]
+
+
+class StatusCache:
+    '''Persists the status of every record with the inputs it depended on.
+
+    The inputs of a record are its stored version (see `recordVersion`),
+    the repo config and the entries of the records it references. File
+    records also depend on the signature of the directory holding the
+    file, which changes whenever a file in it is created, removed or
+    renamed. Each entry is `[version, valid, message]`.
+
+    `check` only evaluates records whose own version changed or that
+    reference a record whose entry changed, everything else keeps its
+    last status. A record whose status did not change does not make the
+    records referencing it be checked again.
+
+    '''
+    fileName = 'datasuper.status.json'
+
+    def __init__(self, db):
+        self.db = db
+        self.path = os.path.join(db.repo.abspath, StatusCache.fileName)
+        self.rechecked = 0
+
+    def _tables(self):
+        # referenced records come before the records referencing them
+        return [
+            ('file_records', self.db.fileTable),
+            ('results', self.db.resultTable),
+            ('samples', self.db.sampleTable),
+            ('sample_groups', self.db.sampleGroupTable),
+        ]
+
+    def _refTables(self):
+        # reference field -> the table its references are resolved in
+        return {
+            'file_records': self.db.fileTable,
+            'results': self.db.resultTable,
+            'direct_results': self.db.resultTable,
+            'direct_samples': self.db.sampleTable,
+            'subgroups': self.db.sampleGroupTable,
+        }
+
+    def _configVersion(self):
+        return recordVersion(self.db.repo.config.data)
+
+    def _generation(self):
+        '''Return the generation of the database records were read from,
+        or None if they may differ from it.
+        '''
+        if any(tbl.changes for tbl in self.db.tables()):
+            return None
+        for _, tbl in self._tables():
+            tbl.getAllRaw()
+        generation = self.db.backend.generation()
+        if generation != self.db.backend.readGeneration:
+            return None
+        return generation
+
+    def _load(self):
+        '''Return what the last status saved, if the config has not
+        changed since.
+        '''
+        try:
+            with open(self.path) as cacheFile:
+                saved = JSONSerializer.loads(cacheFile.read())
+        except (OSError, ValueError):
+            return {}
+        if saved.get('config', None) != self._configVersion():
+            return {}
+        return saved
+
+    def versions(self, workers=None, previous=None):
+        '''Return the current version of every record by primary key.
+
+        The version of a file record ends with `@` and the signature of
+        its directory, or just `@` if the directory changed too recently to
+        be trusted. Directories are signed before their files are checked
+        so that files removed during a check are seen by the next one.
+
+        Args:
+            workers (:obj:`int`, optional): The number of directories
+                signed at once.
+            previous (:obj:`dict`, optional): Entries saved from the
+                database as it is now, their versions are reused rather
+                than serializing every record.
+
+        '''
+        versions = {}
+        for _, tbl in self._tables():
+            for rawRec in tbl.getAllRaw():
+                pk = rawRec['primary_key']
+                try:
+                    versions[pk] = _stored(previous[pk][0])
+                except (KeyError, TypeError):
+                    versions[pk] = recordVersion(rawRec)
+
+        # files are grouped by their stored directory, relative paths of
+        # a directory are resolved once
+        byDir = {}
+        for rawRec in self.db.fileTable.getAllRaw():
+            storedDir = os.path.dirname(rawRec['filepath'])
+            byDir.setdefault(storedDir, []).append(rawRec['primary_key'])
+        dirpaths = [self.db.repo.pathFromRepo(storedDir) for storedDir in byDir]
+        signatures = mapInPool(directorySignature, dirpaths, workers=workers)
+        for pks, signature in zip(byDir.values(), signatures):
+            suffix = '@' + (signature or '')
+            for pk in pks:
+                versions[pk] += suffix
+        return versions
+
+    def save(self, versions, report):
+        '''Save the statuses of `report`, as returned by `check`.'''
+        entries = {}
+        for key, tbl in self._tables():
+            statuses = report[key]
+            for rawRec in tbl.getAllRaw():
+                try:
+                    entries[rawRec['primary_key']] = statuses[rawRec['name']]
+                except KeyError:
+                    pass
+        self._write(versions, entries)
+
+    def _write(self, versions, entries):
+        records = {
+            pk: [versions[pk], valid, msg]
+            for pk, (valid, msg) in entries.items() if pk in versions
+        }
+        saved = {
+            'config': self._configVersion(),
+            'generation': self._generation(),
+            'records': records,
+        }
+        try:
+            with open(self.path + '.tmp', 'w') as cacheFile:
+                cacheFile.write(JSONSerializer.dumps(saved))
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass  # the repo may not be writable, the next check is full
+
+    def _refPKs(self, tbl, rawRec, refTables):
+        '''Return the primary keys referenced by `rawRec`, None for a
+        reference that does not resolve.
+        '''
+        pks = []
+        for field, ref in self.db._refsIn(tbl.typeStored, rawRec):
+            if ref is None:
+                continue
+            refTable = refTables[field]
+            # references are almost always primary keys, which asPK
+            # returns unless they are also the name of a record
+            if ref in refTable.pkToName and ref not in refTable.nameToPK:
+                pks.append(ref)
+                continue
+            try:
+                pks.append(refTable.asPK(ref))
+            except (KeyError, TypeError):
+                pks.append(None)
+        return pks
+
+    def _ordered(self, tbl, refs, refTables):
+        '''Return the primary keys of `tbl` with records referenced from
+        the same table, i.e. subgroups, before the records referencing them.
+        '''
+        pks = [rawRec['primary_key'] for rawRec in tbl.getAllRaw()]
+        if all(refTables[field] is not tbl for field in tbl.typeStored.refFields):
+            return pks
+        out, seen = [], set()
+        for root in pks:
+            stack = [(root, False)]
+            while stack:
+                pk, expanded = stack.pop()
+                if expanded:
+                    out.append(pk)
+                    continue
+                if pk in seen:
+                    continue
+                seen.add(pk)
+                stack.append((pk, True))
+                for ref in refs[pk]:
+                    if ref is not None and ref not in seen and tbl.hasPK(ref):
+                        stack.append((ref, False))
+        return out
+
+    def _evaluate(self, tbl, pk, refs, entries, tableOf):
+        try:
+            rec = tbl.get(pk)
+        except InvalidRecordStateError as irse:
+            return False, 'could_not_instantiate_record:' + str(irse)
+        # records already evaluated give their status to this one rather
+        # than being checked again
+        for ref in refs:
+            if ref in entries:
+                try:
+                    tableOf[ref].get(ref).cachedStatus = entries[ref]
+                except InvalidRecordStateError:
+                    pass
+        try:
+            return rec.detailedStatus()
+        except InvalidRecordStateError as irse:
+            return False, 'could_not_check_status:' + str(irse)
+
+    def _checkFiles(self, dirty, versions, previous, entries, workers):
+        '''Check that the files of the `dirty` file records exist.
+
+        Records are only built if they changed, files that are only
+        checked because a file was added to or removed from their
+        directory are checked from the stored path.
+
+        '''
+        tbl = self.db.fileTable
+        filepaths, fileRecs = {}, {}
+        for pk in dirty:
+            last = previous.get(pk, None)
+            if last is not None and _stored(last[0]) == _stored(versions[pk]) \
+                    and not last[2].startswith('could_not_instantiate_record'):
+                filepaths[pk] = self.db.repo.pathFromRepo(tbl.getRaw(pk)['filepath'])
+                continue
+            try:
+                fileRecs[pk] = tbl.get(pk)
+            except InvalidRecordStateError as irse:
+                entries[pk] = (False, 'could_not_instantiate_record:' + str(irse))
+                continue
+            filepaths[pk] = fileRecs[pk].filepath()
+        existing = existingFiles(filepaths.values(), workers=workers)
+        for pk, filepath in filepaths.items():
+            entries[pk] = FileRecord.existenceStatus(filepath, filepath in existing)
+            if pk in fileRecs:
+                fileRecs[pk].cachedValid, fileRecs[pk].cachedMsg = entries[pk]
+
+    def _evaluateAll(self, previous, versions, workers=None, through=None):
+        '''Return the status of every record by table and by primary key.
+
+        Each record is evaluated at most once, tables are evaluated in
+        dependency order and subgroups before their groups, so that every
+        referenced record already has a status. Statuses are memoized by
+        primary key and given to the records that reference them, which
+        do not walk further down. Records that are clean with respect to
+        `previous` keep their saved status.
+
+        Args:
+            previous (dict): Saved entries by primary key, empty to
+                evaluate every record.
+            versions (dict): The current versions, see `versions`.
+            through (:obj:`DatabaseTable`, optional): Stop after this table.
+
+        '''
+        for _, tbl in self._tables():
+            for rec in tbl.recordCache.values():
+                rec.cachedStatus = None
+            tbl._buildNameTables()
+        refTables = self._refTables()
+        entries, unchanged, tableOf = {}, set(), {}
+        self.rechecked = 0
+        report = {}
+        for key, tbl in self._tables():
+            refs, names = {}, {}
+            for rawRec in tbl.getAllRaw():
+                pk = rawRec['primary_key']
+                refs[pk] = self._refPKs(tbl, rawRec, refTables)
+                names[pk] = rawRec['name']
+                tableOf[pk] = tbl
+
+            dirty = []
+            for pk in self._ordered(tbl, refs, refTables):
+                last = previous.get(pk, None)
+                clean = last is not None and last[0] == versions[pk]
+                clean = clean and not last[0].endswith('@')
+                clean = clean and all(ref in unchanged for ref in refs[pk])
+                if clean:
+                    entries[pk] = (last[1], last[2])
+                    unchanged.add(pk)
+                    continue
+                dirty.append(pk)
+                if tbl is not self.db.fileTable:
+                    entries[pk] = self._evaluate(tbl, pk, refs[pk], entries,
+                                                 tableOf)
+
+            if tbl is self.db.fileTable:
+                self._checkFiles(dirty, versions, previous, entries, workers)
+
+            # records referencing a file only depend on its status, not on
+            # the directory signature
+            for pk in dirty:
+                last = previous.get(pk, None)
+                if last is not None and (last[1], last[2]) == entries[pk] and \
+                        _stored(last[0]) == _stored(versions[pk]):
+                    unchanged.add(pk)
+            self.rechecked += len(dirty)
+            report[key] = {names[pk]: entries[pk] for pk in names}
+            if tbl is through:
+                break
+        return report, entries
+
+    def check(self, workers=None, incremental=True):
+        '''Return the status of every record and save the new statuses.
+
+        Args:
+            workers (:obj:`int`, optional): The number of directories
+                checked at once.
+            incremental (:obj:`bool`, optional): Only check records whose
+                inputs changed since the last status. Defaults to True.
+
+        Returns:
+            A dict of table -> (record name -> (True or False, message)),
+            as returned by `Database.checkStatus`. The number of records
+            evaluated is kept in `rechecked`.
+
+        '''
+        saved = self._load() if incremental else {}
+        previous = saved.get('records', {})
+        generation = self._generation()
+        if generation is not None and saved.get('generation', None) == generation:
+            versions = self.versions(workers=workers, previous=previous)
+        else:
+            versions = self.versions(workers=workers)
+        report, entries = self._evaluateAll(previous, versions, workers=workers)
+        # nothing is written when every saved entry is still current
+        if self.rechecked or len(previous) != len(versions):
+            self._write(versions, entries)
+        return report
+
+    def tableStatus(self, tbl, workers=None):
+        '''Return a map of record names in `tbl` to valid status.
+
+        Only `tbl` and the tables it references are evaluated, nothing is
+        saved.
+
+        '''
+        report, _ = self._evaluateAll({}, {}, workers=workers, through=tbl)
+        for key, statusTbl in self._tables():
+            if statusTbl is tbl:
+                return report[key]
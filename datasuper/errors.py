@@ -14,3 +14,7 @@ class RepoReadOnlyError(Exception):
 
 class TypeNotFoundError(Exception):
     pass
+
+
+class ServerRunningError(Exception):
+    pass
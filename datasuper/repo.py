@@ -1,6 +1,8 @@
 import os.path
-from yaml_backed_structs import PersistentDict, PersistentSet
-from datasuper.database import Database
+from contextlib import contextmanager
+from random import choice as rchoice
+import string
+from .repo_config import RepoConfig
 from .errors import (
     NoRepoFoundError,
     TypeNotFoundError,
@@ -22,38 +24,77 @@ class Repo:
             table that contains sample records.
         sampleGroupTable (datasuper.DatabaseTable): Alias to
             db.sampleGroupTable. The table that contains sample-group records.
+        repoMeta (Mapping): Alias to config.repoMeta, read-only.
+        resultSchema (Mapping): Alias to config.resultSchemas, read-only.
+        fileTypes (Mapping): Alias to config.fileTypes, read-only.
+        sampleTypes (frozenset): Alias to config.sampleTypes.
 
     '''
     repoDirName = '.datasuper'
     dbRoot = 'datasuper.tinydb.json'
-    repoMetaRoot = 'repo-metadata.yml'
-    resultSchemaRoot = 'result-schemas.yml'
-    fileTypesRoot = 'file-types.yml'
-    sampleTypesRoot = 'sample-types.yml'
+    repoMetaRoot = RepoConfig.repoMetaRoot
+    resultSchemaRoot = RepoConfig.resultSchemaRoot
+    fileTypesRoot = RepoConfig.fileTypesRoot
+    sampleTypesRoot = RepoConfig.sampleTypesRoot
+    socketRoot = 'datasuper.sock'
+    # repos kept open by `datasuper serve` or `batch`, returned by `loadRepo`
+    served = {}
 
     def __init__(self, abspath):
         self.closed = False
         self.abspath = abspath
         self.readOnly = True
-
-        dbPath = os.path.join(self.abspath, Repo.dbRoot)
-        self.db = Database.loadDatabase(self, dbPath, self.readOnly)
-        self.fileTable = self.db.fileTable
-        self.resultTable = self.db.resultTable
-        self.sampleTable = self.db.sampleTable
-        self.sampleGroupTable = self.db.sampleGroupTable
-
-        repoMetaPath = os.path.join(self.abspath, Repo.repoMetaRoot)
-        self.repoMeta = PersistentDict(repoMetaPath)
-
-        resultSchemaPath = os.path.join(self.abspath, Repo.resultSchemaRoot)
-        self.resultSchema = PersistentDict(resultSchemaPath)
-
-        fileTypesPath = os.path.join(self.abspath, Repo.fileTypesRoot)
-        self.fileTypes = PersistentDict(fileTypesPath)
-
-        sampleTypesPath = os.path.join(self.abspath, Repo.sampleTypesRoot)
-        self.sampleTypes = PersistentSet(sampleTypesPath)
+        self._db = None
+        self.config = RepoConfig.load(self.abspath)
+
+    @property
+    def db(self):
+        '''The database, opened the first time it is used.'''
+        if self._db is None:
+            from datasuper.database import Database
+            dbPath = os.path.join(self.abspath, Repo.dbRoot)
+            self._db = Database.loadDatabase(self, dbPath, self.readOnly)
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
+
+    @property
+    def repoMeta(self):
+        '''The repo metadata, change it with `config.setItem`.'''
+        return self.config.repoMeta
+
+    @property
+    def resultSchema(self):
+        '''The result schemas by result type, read-only.'''
+        return self.config.resultSchemas
+
+    @property
+    def fileTypes(self):
+        '''The extensions by file type, read-only.'''
+        return self.config.fileTypes
+
+    @property
+    def sampleTypes(self):
+        '''The set of sample types, read-only.'''
+        return self.config.sampleTypes
+
+    @property
+    def fileTable(self):
+        return self.db.fileTable
+
+    @property
+    def resultTable(self):
+        return self.db.resultTable
+
+    @property
+    def sampleTable(self):
+        return self.db.sampleTable
+
+    @property
+    def sampleGroupTable(self):
+        return self.db.sampleGroupTable
 
     def repoId(self):
         '''Return a random id for this repo.
@@ -61,22 +102,62 @@ class Repo:
         Generate and save that id if it does not already exist.
         '''
         try:
-            return self.repoMeta['repo_id']
+            return self.config.repoMeta['repo_id']
         except KeyError:
             N = 20
             chars = string.ascii_uppercase + string.digits
             repoid = [rchoice(chars) for _ in range(N)]
             repoid = ''.join(repoid)
-            self.repoMeta['repo_id'] = repoid
-            return self.repoMeta['repo_id']
+            self.config.setItem('repoMeta', 'repo_id', repoid)
+            return self.config.repoMeta['repo_id']
+
+    def query(self, recType):
+        '''Return a `Query` over the records of `recType`, e.g. SampleRecord.'''
+        from datasuper.database import Query
+        return Query(self.db, recType)
 
     def flush(self):
         """Flush new data to disk."""
-        self.db.flush()
+        if self._db is not None:
+            self.db.flush()
+
+    @contextmanager
+    def transaction(self):
+        '''Group changes so that they are written together or not at all.
+
+        Changes made in the block are kept in memory and written in a
+        single commit when it exits. If an exception is raised every change
+        is discarded. The repo is writable inside the block::
+
+            with repo.transaction():
+                sample.addResult(result)
+                sample.save(modify=True)
+
+        '''
+        readOnly = self.readOnly
+        self.readOnly = False
+        if self.db.inTransaction:
+            # changes belong to the enclosing transaction, e.g. a batch
+            try:
+                yield self
+            finally:
+                self.readOnly = readOnly
+            return
+        self.db.begin()
+        try:
+            yield self
+        except BaseException:
+            self.db.rollback()
+            raise
+        else:
+            self.db.commit()
+        finally:
+            self.readOnly = readOnly
 
     def close(self):
         '''Close the repo to further write operations.'''
-        self.db.close()
+        if self._db is not None:
+            self.db.close()
         self.closed = True
 
     def _notReadOnly(self):
@@ -87,11 +168,11 @@ class Repo:
     def addSampleType(self, sampleType):
         '''Add a new sampleType (str) to the repo.'''
         if self._notReadOnly():
-            self.sampleTypes.add(sampleType)
+            self.config.addItem('sampleTypes', sampleType)
 
     def getSampleTypes(self):
         '''Return a list of sample types in the repo.'''
-        return [el for el in self.sampleTypes]
+        return [el for el in self.config.sampleTypes]
 
     def addFileType(self, fileType, ext=None):
         '''Add a new fileType to the repo with optional extension.'''
@@ -103,55 +184,55 @@ class Repo:
                     ext = fileType['ext']
                 except KeyError:
                     ext = name
-                self.fileTypes[name] = ext
+                self.config.setItem('fileTypes', name, ext)
             else:
                 if ext is None:
                     ext = fileType
-                self.fileTypes[fileType] = ext
+                self.config.setItem('fileTypes', fileType, ext)
 
     def getFileTypes(self):
         '''Return a list of file types in the repo.'''
-        fTypes = self.fileTypes.items()
+        fTypes = self.config.fileTypes.items()
         return [{'name': name, 'ext': ext} for name, ext in fTypes]
 
     def getFileTypeExt(self, fileType):
         '''Return the extension for a given fileType.'''
         try:
-            return self.fileTypes[fileType]
+            return self.config.fileTypes[fileType]
         except KeyError:
             raise TypeNotFoundError(fileType)
 
     def addResultSchema(self, resultType, resultSchema, modify=False):
         '''Set a resultSchema for resultType.'''
         if self._notReadOnly():
-            if modify or (resultType not in self.resultSchema):
-                self.resultSchema[resultType] = resultSchema
+            if modify or (resultType not in self.config.resultSchemas):
+                self.config.setItem('resultSchemas', resultType, resultSchema)
 
     def getResultTypes(self):
         '''Return a list of result types in the repo.'''
-        return [el for el in self.resultSchema.keys()]
+        return [el for el in self.config.resultSchemas.keys()]
 
     def validateSampleType(self, sampleType):
         '''Return sampleType if it is in the repo, else raise an error.'''
-        if sampleType in self.sampleTypes:
+        if sampleType in self.config.sampleTypes:
             return sampleType
         raise TypeNotFoundError(str(sampleType))
 
     def validateResultType(self, resType):
         '''Return resultType if it is in the repo, else raise an error.'''
-        if resType in self.resultSchema:
+        if resType in self.config.resultSchemas:
             return resType
         raise TypeNotFoundError(resType)
 
     def validateFileType(self, fileType):
         '''Return fileType if it is in the repo, else raise an error.'''
-        if fileType in self.fileTypes:
+        if fileType in self.config.fileTypes:
             return fileType
         raise TypeNotFoundError(fileType)
 
     def getResultSchema(self, resType):
         '''Return the schema associated with a resType.'''
-        schema = self.resultSchema[resType]
+        schema = self.config.resultSchemas[resType]
         return schema
 
     def pathFromRepo(self, fpath):
@@ -201,17 +282,30 @@ class Repo:
         Raises:
             NoRepoFoundError: If no repo is found.
         '''
+        repoPath = Repo.findRepo(startDir=startDir, recurse=recurse)
+        try:
+            return Repo.served[repoPath]
+        except KeyError:
+            return Repo(repoPath)
+
+    @staticmethod
+    def findRepo(startDir='.', recurse=True):
+        '''Return the path of the repo directory in or above startDir.
+
+        Searches like `loadRepo` but does not open the repo.
 
+        Raises:
+            NoRepoFoundError: If no repo is found.
+        '''
         startPath = os.path.abspath(startDir)
         if Repo.repoDirName in os.listdir(startPath):
-            repoPath = os.path.join(startPath, Repo.repoDirName)
-            return Repo(repoPath)
+            return os.path.join(startPath, Repo.repoDirName)
 
         up = os.path.dirname(startPath)
         if up == startPath:
             raise NoRepoFoundError()
         if recurse:
-            return Repo.loadRepo(startDir=up)
+            return Repo.findRepo(startDir=up)
         else:
             raise NoRepoFoundError()
 
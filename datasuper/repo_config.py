@@ -0,0 +1,137 @@
+import marshal
+import os
+from types import MappingProxyType
+
+
+def _freeze(value):
+    '''Return an immutable copy of a value read from YAML.'''
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(el) for el in value)
+    return value
+
+
+class RepoConfig:
+    '''The types, result schemas and metadata of a repo.
+
+    The four YAML files are read once into frozen mappings and sets that
+    record constructors can check without going back to YAML. A copy is
+    kept in memory for each repo and in a marshal file next to the YAML
+    files, both are used for as long as the YAML files have not changed.
+
+    Attributes:
+        repoMeta (MappingProxyType): Metadata about the repo.
+        resultSchemas (MappingProxyType): Result type -> schema, a tuple
+            of file types or a mapping of keys to file types.
+        fileTypes (MappingProxyType): File type -> extension.
+        sampleTypes (frozenset): The sample types of the repo.
+
+    '''
+    repoMetaRoot = 'repo-metadata.yml'
+    resultSchemaRoot = 'result-schemas.yml'
+    fileTypesRoot = 'file-types.yml'
+    sampleTypesRoot = 'sample-types.yml'
+    cacheName = 'datasuper.config.cache'
+    # config field -> (YAML file, empty value)
+    fields = {
+        'repoMeta': (repoMetaRoot, {}),
+        'resultSchemas': (resultSchemaRoot, {}),
+        'fileTypes': (fileTypesRoot, {}),
+        'sampleTypes': (sampleTypesRoot, []),
+    }
+    _loaded = {}
+
+    def __init__(self, abspath, stamp, data):
+        self.abspath = abspath
+        self.stamp = stamp
+        self.data = data
+        self._compile()
+
+    def _compile(self):
+        self.repoMeta = _freeze(self.data['repoMeta'])
+        self.resultSchemas = _freeze(self.data['resultSchemas'])
+        self.fileTypes = _freeze(self.data['fileTypes'])
+        self.sampleTypes = frozenset(self.data['sampleTypes'])
+
+    @classmethod
+    def _stamp(cls, abspath):
+        stamp = []
+        for fileName, _ in cls.fields.values():
+            try:
+                st = os.stat(os.path.join(abspath, fileName))
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @classmethod
+    def load(cls, abspath):
+        '''Return the config of the repo at `abspath`.'''
+        stamp = cls._stamp(abspath)
+        try:
+            config = cls._loaded[abspath]
+            if config.stamp == stamp:
+                return config
+        except KeyError:
+            pass
+        try:
+            with open(os.path.join(abspath, cls.cacheName), 'rb') as cacheFile:
+                cachedStamp, data = marshal.load(cacheFile)
+            if cachedStamp != stamp:
+                raise ValueError()
+        except (OSError, ValueError, EOFError, TypeError):
+            data = cls._readYAML(abspath)
+            cls._saveCache(abspath, stamp, data)
+        config = cls(abspath, stamp, data)
+        cls._loaded[abspath] = config
+        return config
+
+    @classmethod
+    def _saveCache(cls, abspath, stamp, data):
+        cachePath = os.path.join(abspath, cls.cacheName)
+        try:
+            with open(cachePath + '.tmp', 'wb') as cacheFile:
+                marshal.dump((stamp, data), cacheFile)
+            os.replace(cachePath + '.tmp', cachePath)
+        except (OSError, ValueError):
+            pass  # the repo may not be writable, the cache is not saved
+
+    @classmethod
+    def _readYAML(cls, abspath):
+        import yaml
+        data = {}
+        for field, (fileName, empty) in cls.fields.items():
+            try:
+                with open(os.path.join(abspath, fileName)) as ymlFile:
+                    data[field] = yaml.safe_load(ymlFile)
+            except FileNotFoundError:
+                data[field] = None
+            if data[field] is None:
+                data[field] = type(empty)()
+        return data
+
+    def set(self, field, value):
+        '''Replace `field` with `value` and save it to its YAML file.'''
+        import yaml
+        fileName, _ = self.fields[field]
+        path = os.path.join(self.abspath, fileName)
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as ymlFile:
+            ymlFile.write(yaml.safe_dump(value))
+        os.replace(tmpPath, path)
+        self.data[field] = value
+        self._compile()
+        self.stamp = self._stamp(self.abspath)
+        self._saveCache(self.abspath, self.stamp, self.data)
+
+    def setItem(self, field, key, value):
+        '''Set `key` of the mapping `field` to `value` and save it.'''
+        updated = dict(self.data[field])
+        updated[key] = value
+        self.set(field, updated)
+
+    def addItem(self, field, value):
+        '''Add `value` to the list `field` and save it.'''
+        if value not in self.data[field]:
+            self.set(field, self.data[field] + [value])
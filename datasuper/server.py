@@ -0,0 +1,161 @@
+import json
+import os
+import socket
+import socketserver
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+from .database import backendFor
+from .errors import ServerRunningError
+from .repo import Repo
+from .repo_config import RepoConfig
+
+
+class RepoClient:
+    '''Sends CLI commands to a `RepoServer` over its Unix socket.
+
+    Args:
+        repoPath (str): The path of the repo directory, as returned by
+            `Repo.findRepo`.
+
+    '''
+
+    def __init__(self, repoPath):
+        self.socketPath = os.path.join(repoPath, Repo.socketRoot)
+
+    def running(self):
+        '''Return True if a server is answering on the socket.'''
+        try:
+            self.run([])
+            return True
+        except OSError:
+            return False
+
+    def run(self, argv, cwd=None):
+        '''Run a CLI command in the server. Return the exit code, stdout
+        and stderr of the command.
+
+        Raises:
+            OSError: If no server is running.
+        '''
+        if cwd is None:
+            cwd = os.getcwd()
+        request = json.dumps({'argv': list(argv), 'cwd': cwd}) + '\n'
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socketPath)
+            sock.sendall(request.encode('utf-8'))
+            with sock.makefile('rb') as response:
+                response = response.readline()
+        if not response:
+            raise ConnectionResetError(self.socketPath)
+        response = json.loads(response.decode('utf-8'))
+        return response['exit'], response['stdout'], response['stderr']
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        if request['argv']:
+            exitCode, out, err = self.server.execute(request['argv'],
+                                                     request['cwd'])
+        else:
+            exitCode, out, err = 0, '', ''  # a ping from `RepoClient.running`
+        response = {'exit': exitCode, 'stdout': out, 'stderr': err}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class RepoServer(socketserver.UnixStreamServer):
+    '''Keeps a repo open and runs CLI commands sent by `RepoClient`.
+
+    Requests are handled one at a time so writes are serialized. While
+    the server runs, `Repo.loadRepo` returns the open repo to commands,
+    whose tables and indexes stay in memory between requests. They are
+    reloaded if another process changes the database.
+
+    '''
+    # True in a process that is running a server
+    active = False
+
+    def __init__(self, repo, cli):
+        self.repo = repo
+        self.cli = cli
+        socketPath = os.path.join(repo.abspath, Repo.socketRoot)
+        if os.path.exists(socketPath):
+            if RepoClient(repo.abspath).running():
+                raise ServerRunningError(socketPath)
+            os.remove(socketPath)
+        super(RepoServer, self).__init__(socketPath, _RequestHandler)
+
+    def warm(self):
+        '''Read every table and the name index into memory.'''
+        for tbl in self.repo.db.tables():
+            tbl.getAllRaw()
+            tbl.hasName(None)
+
+    def refresh(self):
+        '''Drop cached data that another process has changed on disk.
+
+        Built records are always dropped, the statuses they cache depend
+        on files that may have changed since the last command.
+        '''
+        self.repo.config = RepoConfig.load(self.repo.abspath)
+        db = self.repo._db
+        if db is None:
+            return
+        for tbl in db.tables():
+            tbl.clearRecords()
+        if type(db.backend) is not backendFor(self.repo.abspath):
+            # the repo was migrated, its database is opened again
+            db.backend.rollback()
+            db.backend.close()
+            self.repo.db = None
+            return
+        if db.backend.readGeneration is None:
+            return
+        if db.backend.generation() != db.backend.readGeneration:
+            db.rollback()
+            db.backend.readGeneration = db.backend.generation()
+
+    def execute(self, argv, cwd):
+        '''Run a CLI command. Return its exit code, stdout and stderr.'''
+        self.refresh()
+        out, err = StringIO(), StringIO()
+        exitCode = 0
+        os.chdir(cwd)
+        try:
+            with redirect_stdout(out), redirect_stderr(err):
+                self.cli.main(args=argv, prog_name='datasuper')
+        except SystemExit as exit:
+            if isinstance(exit.code, int):
+                exitCode = exit.code
+            elif exit.code is not None:
+                err.write(str(exit.code) + '\n')
+                exitCode = 1
+        except Exception:
+            err.write(traceback.format_exc())
+            exitCode = 1
+        finally:
+            # a command that did not save its changes would have lost them
+            # on exit, so they are not kept for later commands either
+            self.repo.readOnly = True
+            db = self.repo._db
+            if db is not None and any(tbl.changes for tbl in db.tables()):
+                db.rollback()
+        return exitCode, out.getvalue(), err.getvalue()
+
+    def serve(self):
+        '''Handle requests until interrupted or `shutdown` is called.'''
+        RepoServer.active = True
+        Repo.served[self.repo.abspath] = self.repo
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            del Repo.served[self.repo.abspath]
+            RepoServer.active = False
+            self.server_close()
+            os.remove(self.server_address)
+            self.repo.close()
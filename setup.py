@@ -18,7 +18,7 @@ dependencies = [
     'py-archy~=1.0.1',
     'PyYAML~=3.12',
     'tinydb~=3.5.0',
-    'ujson~=1.35',
+    'ujson>=5.4',
     'yaml_backed_structs~=1.0.0',
 ]
 
@@ -60,6 +60,11 @@ setup(
 
     install_requires=dependencies,
 
+    extras_require={
+        'msgpack': ['msgpack>=1.0'],
+        'xxhash': ['xxhash>=2.0'],
+    },
+
     entry_points={
         'console_scripts': [
             'datasuper=datasuper.cli:main'
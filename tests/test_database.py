@@ -0,0 +1,1034 @@
+"""Test database storage."""
+
+import copy
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from datasuper import (
+    ConcurrentWriteError,
+    Repo,
+    RepoConfig,
+    Database,
+    FileRecord,
+    InvalidRecordStateError,
+    RecordExistsError,
+    ResultRecord,
+    RepoClient,
+    RepoServer,
+    SampleGroupRecord,
+    SampleRecord,
+    ServerRunningError,
+    SQLiteBackend,
+    StatusCache,
+    makeFile,
+    makeResult,
+    existingFiles,
+    hashFile,
+    makeSample,
+    MsgpackBackend,
+    TinyDBBackend,
+)
+from datasuper.database import serializers
+
+from .base_test import BaseTestDataSuper
+
+
+class BaseTestDatabase(BaseTestDataSuper):
+    """Build a small repo with one of each record."""
+
+    def setUp(self):
+        super(BaseTestDatabase, self).setUp()
+        Repo.initRepo()
+        self.repo = Repo.loadRepo()
+        self.repo.readOnly = False
+        self.repo.addSampleType('env')
+        self.repo.addFileType('txt')
+        self.repo.addResultSchema('pair', {'a': 'txt', 'b': 'txt'})
+        for fname in ['a.txt', 'b.txt']:
+            with open(fname, 'w') as f:
+                f.write(fname)
+        makeFile(self.repo, 'file_a', 'a.txt', 'txt')
+        makeFile(self.repo, 'file_b', 'b.txt', 'txt')
+        makeResult(self.repo, 'res', 'pair', {'a': 'file_a', 'b': 'file_b'})
+        sample = makeSample(self.repo, 'samp', 'env')
+        sample.addResult('res')
+        sample.save(modify=True)
+        self.repo.flush()
+
+    def reopenDatabase(self):
+        """Return a freshly loaded database for the test repo."""
+        return Database.loadDatabase(self.repo, None, True)
+
+    def upgradeChecksums(self):
+        """Replace the checksums stored for new files with full checksums.
+        Return the database of the test repo, loaded again.
+        """
+        from click.testing import CliRunner
+        from datasuper.cli import main
+        result = CliRunner().invoke(main, ['verify', '--upgrade'])
+        assert result.exit_code == 0, result.output
+        self.repo.db = self.reopenDatabase()
+        return self.repo.db
+
+
+class TestDatabaseBackends(BaseTestDatabase):
+    """Test storage backends."""
+
+    def test_json_roundtrip(self):
+        """Ensure records survive a flush to the JSON file."""
+        db = self.reopenDatabase()
+        assert db.sampleTable.getRaw('samp')['results'] == [self.repo.db.asPK('res')]
+        assert db.fileTable.size() == 2
+
+    def test_migrate_to_sqlite(self):
+        """Ensure migrating keeps every record and switches backend."""
+        before = self.repo.db.resultTable.getRaw('res')
+        Database.migrate(self.repo, SQLiteBackend.name)
+        assert SQLiteBackend.existsIn(self.repo.abspath)
+        assert os.path.isfile(os.path.join(self.repo.abspath,
+                                           Database.dbName + '.bak'))
+        db = self.reopenDatabase()
+        assert isinstance(db.backend, SQLiteBackend)
+        assert db.resultTable.getRaw('res') == before
+        assert db.sampleTable.size() == 1
+
+    def test_sqlite_rename_and_remove(self):
+        """Ensure point updates and removals persist in SQLite."""
+        Database.migrate(self.repo, SQLiteBackend.name)
+        db = Database.loadDatabase(self.repo, None, False)
+        samplePK = db.asPK('samp')
+        db.sampleTable.rename(samplePK, 'samp2')
+        db.fileTable.remove('file_b')
+        db.close()
+        db = self.reopenDatabase()
+        assert db.sampleTable.getRaw(samplePK)['name'] == 'samp2'
+        assert not db.fileTable.exists('file_b')
+
+    def test_partial_update(self):
+        """Ensure an update of some fields keeps the others on every backend."""
+        backends = [TinyDBBackend, SQLiteBackend]
+        if serializers.msgpack is not None:
+            backends.insert(1, MsgpackBackend)
+        for backend in backends:
+            Database.migrate(Repo.loadRepo(), backend.name)
+            db = Database.loadDatabase(self.repo, None, False)
+            samplePK = db.asPK('samp')
+            expected = dict(db.sampleTable.getRaw(samplePK),
+                            metadata={'city': backend.name})
+            db.sampleTable.update(samplePK, {'name': 'samp',
+                                             'metadata': {'city': backend.name}})
+            assert db.sampleTable.getRaw(samplePK) == expected
+            db.close()
+            db = self.reopenDatabase()
+            assert type(db.backend) is backend
+            assert db.sampleTable.getRaw(samplePK) == expected
+            assert db.sampleTable.get('samp').metadata == {'city': backend.name}
+
+    def test_sqlite_update_many_before_flush(self):
+        """Ensure several records of a table can be updated in one flush."""
+        makeSample(self.repo, 'samp2', 'env')
+        self.repo.flush()
+        Database.migrate(self.repo, SQLiteBackend.name)
+        with Repo.loadRepo() as repo:
+            for name in ['samp', 'samp2']:
+                sample = repo.sampleTable.get(name)
+                sample.metadata['city'] = name
+                sample.save(modify=True)
+            assert repo.sampleTable.get('samp2').metadata == {'city': 'samp2'}
+        db = self.reopenDatabase()
+        assert isinstance(db.backend, SQLiteBackend)
+        for name in ['samp', 'samp2']:
+            assert db.sampleTable.get(name).metadata == {'city': name}
+        assert [res.name for res in db.sampleTable.get('samp').results()] == ['res']
+
+    @unittest.skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_migrate_to_msgpack_and_back(self):
+        """Ensure records survive a round trip through msgpack."""
+        before = [tbl.getAllRaw() for tbl in self.repo.db.tables()]
+        Database.migrate(self.repo, MsgpackBackend.name)
+        db = self.reopenDatabase()
+        assert isinstance(db.backend, MsgpackBackend)
+        db.backend.compact()
+        db = self.reopenDatabase()
+        assert [tbl.getAllRaw() for tbl in db.tables()] == before
+        Database.migrate(Repo.loadRepo(), TinyDBBackend.name)
+        db = self.reopenDatabase()
+        assert type(db.backend) is TinyDBBackend
+        assert [tbl.getAllRaw() for tbl in db.tables()] == before
+
+
+class TestSerializers(BaseTestDataSuper):
+    """Test the codecs used for database files."""
+
+    data = {
+        'table': {
+            '1': {'name': 'caf\u00e9 / \u2603', 'size': 2 ** 70,
+                  'ratio': 0.1 + 0.2, 'refs': ['a', 'b'], 'missing': None,
+                  'nested': {'ok': True, 'n': -3}},
+        },
+    }
+
+    def test_json_roundtrip(self):
+        """Ensure JSON is read back the same and by the stdlib codec."""
+        dumped = serializers.JSONSerializer.dumps(self.data)
+        assert serializers.JSONSerializer.loads(dumped) == self.data
+        assert json.loads(dumped) == self.data
+        assert serializers.JSONSerializer.loads(json.dumps(self.data)) == self.data
+
+    @unittest.skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_roundtrip(self):
+        """Ensure msgpack is read back the same."""
+        data = copy.deepcopy(self.data)
+        data['table']['1']['size'] = 2 ** 60  # msgpack ints are 64 bit
+        dumped = serializers.MsgpackSerializer.dumps(data)
+        assert serializers.MsgpackSerializer.loads(dumped) == data
+
+
+class TestRemove(BaseTestDatabase):
+    """Test removing records."""
+
+    def test_indexes_survive_remove(self):
+        """Ensure the cached records stay addressable after a removal."""
+        fileTable = self.repo.db.fileTable
+        filePK = fileTable.asPK('file_b')
+        fileTable.getAll()
+        fileTable.remove('file_a')
+        assert fileTable.size() == 1
+        assert fileTable.get('file_b').primaryKey == filePK
+        assert fileTable.pk_index is not None
+        self.repo.flush()
+        assert self.reopenDatabase().fileTable.getRaw(filePK)['name'] == 'file_b'
+
+    def test_dangling_file_reference(self):
+        """Ensure a result whose file record was removed is reported invalid."""
+        from click.testing import CliRunner
+        from datasuper.cli import main
+        self.repo.db.fileTable.get('file_b').remove(atomic=True)
+        self.repo.flush()
+        status = self.repo.db.checkStatus()
+        assert status['results']['res'] == (
+            False, 'could_not_check_status:Could not convert key to file record'
+        )
+        assert not status['samples']['samp'][0]
+        runner = CliRunner()
+        for command in [['status'], ['view', 'results'], ['tree', 'samples']]:
+            result = runner.invoke(main, command)
+            assert result.exception is None, result.output
+
+    def test_remove_invalids(self):
+        """Ensure invalid records are removed from every index."""
+        os.remove('b.txt')
+        self.repo.db.fileTable.removeInvalids()
+        db = self.repo.db
+        assert db.nameNotUsed('file_b')
+        assert db.fileTable.size() == 1
+        self.repo.flush()
+        assert self.reopenDatabase().fileTable.size() == 1
+
+
+class TestMetadata(BaseTestDatabase):
+    """Test structured metadata and the metadata index."""
+
+    def setUp(self):
+        super(TestMetadata, self).setUp()
+        places = [('NYC', 'rail'), ('NYC', 'bench'), ('LA', 'rail')]
+        for i, (city, surface) in enumerate(places):
+            SampleRecord(self.repo, name='s{}'.format(i), sample_type='env',
+                         metadata={'city': city, 'surface': surface,
+                                   'tags': ['a', 'b']}).save()
+        self.repo.flush()
+        self.repo.db.rollback()
+
+    def test_stored_as_json(self):
+        """Ensure metadata is saved as a mapping, and old strings are read."""
+        db = self.reopenDatabase()
+        assert db.sampleTable.getRaw('s0')['metadata']['city'] == 'NYC'
+        assert db.sampleTable.get('samp').metadata == {}
+        legacy = SampleRecord(self.repo, name='old', sample_type='env',
+                              metadata="{'city': 'NYC'}")
+        assert legacy.metadata == {'city': 'NYC'}
+
+    def test_query(self):
+        """Ensure metadata queries use the index, not records."""
+        tbl = self.repo.db.sampleTable
+        pks = tbl.pksWithMetadata({'city': 'NYC', 'surface': 'rail'})
+        assert {tbl.asName(pk) for pk in pks} == {'s0'}
+        assert len(tbl.pksWhereMetadata('city', ['NYC', 'LA'])) == 3
+        assert len(tbl.pksWhereMetadata('tags', ['b'])) == 3
+        assert not tbl.recordCache and tbl.cached_recs is None
+
+    def test_index_follows_changes(self):
+        """Ensure the index is updated by saves and removals."""
+        tbl = self.repo.db.sampleTable
+        assert len(tbl.pksWithMetadata({'city': 'LA'})) == 1
+        sample = tbl.get('s1')
+        sample.metadata['city'] = 'LA'
+        sample.save(modify=True)
+        tbl.remove('s2')
+        names = {tbl.asName(pk) for pk in tbl.pksWithMetadata({'city': 'LA'})}
+        assert names == {'s1'}
+        assert tbl.getRaw('s1')['metadata']['surface'] == 'bench'
+
+    def test_remove_key(self):
+        """Ensure a key deleted from the metadata is removed when saved."""
+        tbl = self.repo.db.sampleTable
+        sample = tbl.get('s0')
+        del sample.metadata['city']
+        sample.metadata['x'] = 1
+        sample.save(modify=True)
+        self.repo.flush()
+        assert self.reopenDatabase().sampleTable.getRaw('s0')['metadata'] == {
+            'surface': 'rail', 'tags': ['a', 'b'], 'x': 1,
+        }
+        assert tbl.pksWithMetadata({'city': 'NYC'}) == {tbl.asPK('s1')}
+
+
+class TestQuery(BaseTestDatabase):
+    """Test queries over tables."""
+
+    def setUp(self):
+        super(TestQuery, self).setUp()
+        makeFile(self.repo, 'file_c', 'a.txt', 'txt')
+        makeFile(self.repo, 'file_d', 'b.txt', 'txt')
+        makeResult(self.repo, 'res2', 'pair', {'a': 'file_c', 'b': 'file_d'})
+        SampleRecord(self.repo, name='samp2', sample_type='env',
+                     metadata={'city': 'NYC'}, results=['res2']).save()
+        group = SampleGroupRecord(self.repo, name='g1')
+        group.addSample('samp')
+        group.save()
+        self.repo.flush()
+
+    def test_where(self):
+        """Ensure conditions on indexed and plain fields are combined."""
+        q = self.repo.query(FileRecord)
+        assert q.count() == 4
+        stored = self.repo.db.fileTable.getRaw('file_b')['filepath']
+        assert [f.name for f in q.where(filepath=stored)] == ['file_b', 'file_d']
+        assert q.where(filepath=stored, name=['file_a', 'file_d']).count() == 1
+        samples = self.repo.query(SampleRecord).where(sample_type='env')
+        assert samples.where(metadata__city='NYC').first().name == 'samp2'
+        assert samples.where(results='res').first().name == 'samp'
+        assert not samples.where(metadata__city='LA').exists()
+
+    def test_in_group(self):
+        """Ensure group membership follows samples to results and files."""
+        def names(recType):
+            return {rec.name for rec in self.repo.query(recType).inGroup('g1')}
+        assert names(SampleRecord) == {'samp'}
+        assert names(ResultRecord) == {'res'}
+        assert names(FileRecord) == {'file_a', 'file_b'}
+
+    def test_count_builds_no_records(self):
+        """Ensure count and exists answer from raw records."""
+        self.repo.db.rollback()
+        q = self.repo.query(ResultRecord).where(result_type='pair')
+        assert q.where(metadata__x=1).count() == 0
+        assert q.count() == 2 and q.exists()
+        assert not self.repo.db.resultTable.recordCache
+
+    def test_cli(self):
+        """Ensure the query command prints matches."""
+        from click.testing import CliRunner
+        from datasuper.cli import main
+        runner = CliRunner()
+        result = runner.invoke(main, ['query', 'samples', 'metadata__city=NYC,LA'])
+        assert result.output.split() == ['samp2', 'env']
+        result = runner.invoke(main, ['query', 'files', '-g', 'g1', '--count'])
+        assert result.output == '2\n'
+        result = runner.invoke(main, ['query', 'results', 'name=nope', '--exists'])
+        assert result.exit_code == 1
+
+
+class TestChecksums(BaseTestDatabase):
+    """Test full file checksums and verification."""
+
+    def setUp(self):
+        super(TestChecksums, self).setUp()
+        self.content = bytes(range(256)) * 40
+        with open('big.txt', 'wb') as f:
+            f.write(self.content)
+        self.fileRec = makeFile(self.repo, 'big', 'big.txt', 'txt')
+        self.repo.flush()
+
+    def test_whole_file_is_hashed(self):
+        """Ensure adding a file only reads its start, and that full
+        checksums cover the whole file.
+        """
+        assert self.fileRec.checksum == \
+            hashlib.sha256(self.content[:4096]).hexdigest()
+        expected = 'sha256:' + hashlib.sha256(self.content).hexdigest()
+        assert self.fileRec.fullChecksum() == expected
+        db = self.upgradeChecksums()
+        assert db.fileTable.getRaw('big')['checksum'] == expected
+        assert hashFile('big.txt', 'blake2b', chunkSize=100) == \
+            'blake2b:' + hashlib.blake2b(self.content).hexdigest()
+        with self.assertRaises(ValueError):
+            hashFile('big.txt', 'md4')
+
+    def test_verify(self):
+        """Ensure changes past the first 4096 bytes and missing files fail."""
+        db = self.upgradeChecksums()
+        fileRec = db.fileTable.get('big')
+        assert fileRec.verify() == (True, 'all_good')
+        with open('big.txt', 'r+b') as f:
+            f.seek(8000)
+            f.write(b'x')
+        assert fileRec.verify()[1].startswith('bad_checksum')
+        os.remove('a.txt')
+        statuses, report = FileRecord.verifyMany(
+            db.fileTable.getAll(), workers=4
+        )
+        assert not statuses['big'][0]
+        assert statuses['file_a'][1].startswith('file_not_found')
+        assert statuses['file_b'][0]
+        # both files were hashed since they last changed
+        assert report.files == 0
+
+    def test_upgrade_legacy_checksums(self):
+        """Ensure verify --upgrade replaces checksums of the first 4096 bytes."""
+        from click.testing import CliRunner
+        from datasuper.cli import main
+        rawRec = dict(self.repo.db.fileTable.getRaw('big'))
+        rawRec['checksum'] = hashlib.sha256(self.content[:4096]).hexdigest()
+        self.repo.db.fileTable.update('big', rawRec)
+        self.repo.flush()
+        assert self.repo.db.fileTable.get('big').verify()[0]
+        result = CliRunner().invoke(main, ['verify', '--upgrade', '-a', 'blake2b'])
+        assert result.exit_code == 0, result.output
+        checksum = self.reopenDatabase().fileTable.getRaw('big')['checksum']
+        assert checksum == 'blake2b:' + hashlib.blake2b(self.content).hexdigest()
+
+
+class TestChecksumCache(BaseTestDatabase):
+    """Test the stat keyed checksum cache."""
+
+    def test_unchanged_files_are_not_hashed(self):
+        """Ensure only changed files are hashed again, also by new processes."""
+        db = self.upgradeChecksums()
+        with open('a.txt', 'a') as f:
+            f.write('more')
+        statuses, report = FileRecord.verifyMany(db.fileTable.getAll())
+        assert not statuses['file_a'][0] and statuses['file_b'][0]
+        assert report.files == 1
+        cache = db.checksumCache
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_prune(self):
+        """Ensure entries of changed and removed files are pruned."""
+        cache = self.repo.db.checksumCache
+        hashFile('a.txt')
+        cache.checksum('a.txt', 'blake2b')
+        os.remove('b.txt')
+        with open('a.txt', 'a') as f:
+            f.write('more')
+        cache.checksum('a.txt', 'sha256')
+        cache.save()
+        assert cache.prune([os.path.abspath(p) for p in ['a.txt', 'b.txt']]) == 1
+        self.repo.db._checksumCache = None
+        self.repo.db.checksumCache._load()
+        assert list(self.repo.db.checksumCache.entries.values()) == [hashFile('a.txt')]
+
+
+class TestFileExistence(BaseTestDatabase):
+    """Test checking files by listing their directories."""
+
+    def test_existing_files(self):
+        """Ensure listing directories agrees with isfile."""
+        os.makedirs('reads/sub')
+        paths = [os.path.abspath('reads/r{}.txt'.format(i)) for i in range(6)]
+        for filepath in paths[:5]:
+            open(filepath, 'w').close()
+        os.symlink(paths[0], 'reads/link.txt')
+        paths += [os.path.abspath(p) for p in
+                  ['reads/link.txt', 'reads/sub', 'missing/a.txt', 'a.txt']]
+        expected = {p for p in paths if os.path.isfile(p)}
+        assert existingFiles(paths, workers=3) == expected
+        assert len(expected) == 7
+
+    def test_status_uses_listing(self):
+        """Ensure file statuses are shared and earlier statuses dropped."""
+        os.remove('b.txt')
+        status = self.repo.db.checkStatus()
+        assert status['file_records']['file_a'] == (True, 'all_good')
+        assert status['file_records']['file_b'][1].startswith('file_not_found')
+        assert status['results']['res'][1].startswith('bad_file_status')
+        assert self.repo.db.fileTable.get('file_b').cachedValid is False
+
+
+class TestIncrementalStatus(BaseTestDatabase):
+    """Test reusing the statuses saved by the last status check."""
+
+    def setUp(self):
+        super(TestIncrementalStatus, self).setUp()
+        SampleGroupRecord(self.repo, name='sub', direct_samples=['samp']).save()
+        SampleGroupRecord(self.repo, name='top', subgroups=['sub']).save()
+        self.repo.flush()
+        self.ageDirectory(10)
+
+    def ageDirectory(self, seconds):
+        """Date the test directory `seconds` seconds back, as if it had not
+        changed since.
+        """
+        mtime = os.stat('.').st_mtime_ns - seconds * 10**9
+        os.utime('.', ns=(mtime, mtime))
+
+    def check(self):
+        statusCache = StatusCache(self.repo.db)
+        return statusCache.check(), statusCache.rechecked
+
+    def test_nothing_changed(self):
+        """Ensure an unchanged repo is not checked again."""
+        full = self.repo.db.checkStatus()
+        assert self.check() == (full, 0)
+        assert full['sample_groups']['top'] == (True, 'all_good')
+
+    def test_removed_file(self):
+        """Ensure a removed file is seen through every record using it."""
+        self.repo.db.checkStatus()
+        os.remove('b.txt')
+        self.ageDirectory(5)
+        status, rechecked = self.check()
+        assert status['file_records']['file_b'][1].startswith('file_not_found')
+        assert status['sample_groups']['top'][1].startswith('bad_subgroup_status')
+        assert rechecked == 6
+        assert self.check() == (status, 0)
+        assert self.repo.db.checkStatus() == status
+
+    def test_changed_record(self):
+        """Ensure only a changed record and those referencing it are checked."""
+        self.repo.db.checkStatus(incremental=True)
+        sample = self.repo.db.sampleTable.get('samp')
+        sample.metadata['city'] = 'NYC'
+        sample.save(modify=True)
+        assert self.check()[1] == 3
+
+    def test_recent_directory(self):
+        """Ensure files of a directory that just changed are checked again,
+        without checking the records using them.
+        """
+        self.repo.db.checkStatus()
+        os.utime('.')
+        assert self.check()[1] == 2
+        assert StatusCache(self.repo.db).versions()[
+            self.repo.db.fileTable.asPK('file_a')
+        ].endswith('@')
+
+    def test_each_record_evaluated_once(self):
+        """Ensure one pass evaluates records reached by several paths once."""
+        top = self.repo.db.sampleGroupTable.get('top')
+        top.addSample('samp')
+        top.addResult('res')
+        top.save(modify=True)
+        evaluated = []
+        detailedStatus = ResultRecord._detailedStatus
+
+        def countingStatus(rec):
+            evaluated.append(rec.name)
+            return detailedStatus(rec)
+
+        ResultRecord._detailedStatus = countingStatus
+        try:
+            status = self.repo.db.checkStatus()
+        finally:
+            ResultRecord._detailedStatus = detailedStatus
+        assert evaluated == ['res']
+        assert status['sample_groups']['top'] == (True, 'all_good')
+        assert self.repo.db.sampleTable.checkStatus() == status['samples']
+
+
+class TestRecordCache(BaseTestDatabase):
+    """Test the cache of records built by get."""
+
+    def test_get_reuses_records(self):
+        """Ensure records are reused until they change."""
+        fileTable = self.repo.db.fileTable
+        fileRec = fileTable.get('file_a')
+        assert fileTable.get(fileRec.primaryKey) is fileRec
+        fileRec.rename('file_a2')
+        assert fileTable.get('file_a2') is not fileRec
+        assert fileTable.get('file_a2').name == 'file_a2'
+
+    def test_eviction(self):
+        """Ensure the least recently used record is dropped first."""
+        fileTable = self.repo.db.fileTable
+        fileTable.recordCacheSize = 1
+        fileTable.recordCache.clear()
+        fileA = fileTable.get('file_a')
+        fileTable.get('file_b')
+        assert fileTable.get('file_a') is not fileA
+        assert list(fileTable.recordCache) == [fileTable.asPK('file_a')]
+
+
+class TestCompactRecords(BaseTestDatabase):
+    """Test the memory layout of records."""
+
+    def test_records_have_no_dict(self):
+        """Ensure records use slots rather than a per instance dict."""
+        for tbl in self.repo.db.tables():
+            for rec in tbl.getAll():
+                assert not hasattr(rec, '__dict__')
+
+    def test_primary_keys_are_shared(self):
+        """Ensure references reuse the primary key string they point to."""
+        db = self.reopenDatabase()
+        samplePK = db.asPK('samp')
+        resultPK = db.sampleTable.getRaw(samplePK)['results'][0]
+        assert resultPK is db.resultTable.getRaw(resultPK)['primary_key']
+
+
+class TestLazyReferences(BaseTestDatabase):
+    """Test resolving references when they are first used."""
+
+    def test_references_resolve_on_use(self):
+        """Ensure building a record does not resolve its references."""
+        sample = SampleRecord(self.repo, name='lazy', sample_type='env',
+                              results=['no_such_result'])
+        assert sample.name == 'lazy'
+        with self.assertRaises(InvalidRecordStateError):
+            sample.to_dict()
+        sample = SampleRecord(self.repo, name='lazy', sample_type='env',
+                              results=['res'])
+        assert sample.results()[0].name == 'res'
+
+
+class TestJournal(BaseTestDatabase):
+    """Test the journal kept by the JSON backend."""
+
+    def test_flush_appends_to_journal(self):
+        """Ensure a flush only appends changes and they are replayed."""
+        backend = self.repo.db.backend
+        dbSize = os.path.getsize(backend.dbPath(self.repo.abspath))
+        self.repo.db.sampleTable.rename('samp', 'samp2')
+        self.repo.flush()
+        assert os.path.getsize(backend.dbPath(self.repo.abspath)) == dbSize
+        with open(backend.journalPath) as journal:
+            assert json.loads(journal.readlines()[-2])['op'] == 'update'
+        db = self.reopenDatabase()
+        assert db.sampleTable.exists('samp2')
+        assert not db.sampleTable.exists('samp')
+
+    def test_compaction(self):
+        """Ensure the journal is folded into the JSON file past the threshold."""
+        backend = self.repo.db.backend
+        backend.compactThreshold = 0
+        self.repo.db.fileTable.remove('file_b')
+        self.repo.flush()
+        assert not os.path.isfile(backend.journalPath)
+        db = self.reopenDatabase()
+        assert db.fileTable.size() == 1
+        assert db.resultTable.exists('res')
+
+
+class TestNameIndex(BaseTestDatabase):
+    """Test the name index saved next to the database."""
+
+    def test_names_resolve_without_loading_tables(self):
+        """Ensure a saved index answers name lookups on its own."""
+        db = self.reopenDatabase()
+        assert db.asPK('samp') == self.repo.db.asPK('samp')
+        assert db.backend._tdb is None
+
+    def test_index_follows_changes(self):
+        """Ensure renames and removals are saved to the index."""
+        samplePK = self.repo.db.asPK('samp')
+        self.repo.db.sampleTable.rename('samp', 'samp2')
+        self.repo.db.fileTable.remove('file_b')
+        self.repo.flush()
+        db = self.reopenDatabase()
+        assert db.asName(samplePK) == 'samp2'
+        assert db.nameNotUsed('file_b')
+        assert db.backend._tdb is None
+
+    def test_stale_index_is_rebuilt(self):
+        """Ensure an index that does not match the database is not used."""
+        samplePK = self.repo.db.asPK('samp')
+        self.repo.db.sampleTable.rename('samp', 'samp2')
+        self.repo.db.backend.flush()
+        db = self.reopenDatabase()
+        assert db.asName(samplePK) == 'samp2'
+
+
+class TestTypeIndex(BaseTestDatabase):
+    """Test the secondary indexes on record types."""
+
+    def test_index_follows_changes(self):
+        """Ensure the type index tracks inserts and removals."""
+        resultTable = self.repo.db.resultTable
+        assert resultTable.pksOfType(['pair']) == {resultTable.asPK('res')}
+        self.repo.addResultSchema('single', ['txt'])
+        makeResult(self.repo, 'res2', 'single', ['file_a'])
+        assert resultTable.pksOfType(['single']) == {resultTable.asPK('res2')}
+        resultTable.remove('res')
+        assert resultTable.pksOfType(['pair']) == set()
+
+    def test_results_by_type(self):
+        """Ensure samples only build results of the requested type."""
+        self.repo.addResultSchema('single', ['txt'])
+        res2 = makeResult(self.repo, 'res2', 'single', ['file_a'])
+        sample = self.repo.db.sampleTable.get('samp')
+        sample.addResult(res2)
+        sample = sample.save(modify=True)
+        results = sample.results(resultTypes=['single'])
+        assert [result.name for result in results] == ['res2']
+        assert len(sample.results()) == 2
+
+
+class TestReferenceIndex(BaseTestDatabase):
+    """Test the index of references between records."""
+
+    def test_referrers(self):
+        """Ensure references can be followed backwards."""
+        db = self.repo.db
+        assert db.referrers('file_a') == {db.asPK('res')}
+        assert db.referrers('res', fields=['results']) == {db.asPK('samp')}
+        assert db.dependents('file_a') == {db.asPK('res'), db.asPK('samp')}
+        assert db.isOrphan('samp')
+
+    def test_remove_result(self):
+        """Ensure removing a result unlinks it and keeps shared files."""
+        self.repo.addResultSchema('single', ['txt'])
+        makeResult(self.repo, 'res2', 'single', ['file_a'])
+        db = self.repo.db
+        db.resultTable.get('res').remove()
+        assert db.sampleTable.getRaw('samp')['results'] == []
+        assert db.fileTable.exists('file_a')
+        assert not db.fileTable.exists('file_b')
+        assert db.referrers('file_a') == {db.asPK('res2')}
+
+
+class TestBulkInsert(BaseTestDatabase):
+    """Test inserting many records at once."""
+
+    def test_save_many(self):
+        """Ensure batches of files and results are saved together."""
+        fileRecs = []
+        for ind in range(3):
+            fname = 'bulk{}.txt'.format(ind)
+            with open(fname, 'w') as f:
+                f.write(fname)
+            fileRecs.append(FileRecord(self.repo, name=fname,
+                                       filepath=fname, file_type='txt'))
+        FileRecord.saveMany(self.repo, fileRecs)
+        results = [
+            ResultRecord(self.repo, name='bulkres', result_type='pair',
+                         file_records={'a': fileRecs[0], 'b': fileRecs[1]}),
+        ]
+        ResultRecord.saveMany(self.repo, results)
+        db = self.repo.db
+        assert db.fileTable.size() == 5
+        assert db.asPK('bulk2.txt') == fileRecs[2].primaryKey
+        assert db.referrers('bulk0.txt') == {results[0].primaryKey}
+        self.repo.flush()
+        assert self.reopenDatabase().resultTable.exists('bulkres')
+
+    def test_duplicate_names_write_nothing(self):
+        """Ensure a batch with a used name is rejected as a whole."""
+        newRecords = [
+            {'primary_key': None, 'name': 'new_file'},
+            {'primary_key': None, 'name': 'file_a'},
+        ]
+        with self.assertRaises(RecordExistsError):
+            self.repo.db.fileTable.insertMany(newRecords)
+        assert self.repo.db.fileTable.size() == 2
+        assert self.repo.db.nameNotUsed('new_file')
+
+
+class TestTransaction(BaseTestDatabase):
+    """Test grouping changes in a transaction."""
+
+    def test_commit(self):
+        """Ensure a transaction is written as one commit."""
+        backend = self.repo.db.backend
+        with open(backend.journalPath) as journal:
+            nLines = len(journal.readlines())
+        with self.repo.transaction():
+            self.repo.db.sampleTable.rename('samp', 'samp2')
+            self.repo.db.fileTable.rename('file_a', 'file_a2')
+            self.repo.flush()
+            with open(backend.journalPath) as journal:
+                assert len(journal.readlines()) == nLines
+        with open(backend.journalPath) as journal:
+            lines = journal.readlines()
+        assert len(lines) == nLines + 3
+        assert json.loads(lines[-1]) == {"op": "commit"}
+        assert self.reopenDatabase().fileTable.exists('file_a2')
+
+    def test_rollback(self):
+        """Ensure an exception discards every change in the transaction."""
+        with self.assertRaises(ValueError):
+            with self.repo.transaction():
+                self.repo.db.sampleTable.rename('samp', 'samp2')
+                self.repo.db.fileTable.remove('file_b')
+                raise ValueError()
+        db = self.repo.db
+        assert db.sampleTable.exists('samp')
+        assert db.fileTable.exists('file_b')
+        assert db.referrers('file_b') == {db.asPK('res')}
+        self.repo.flush()
+        assert self.reopenDatabase().sampleTable.exists('samp')
+
+
+class TestConcurrentWriters(BaseTestDatabase):
+    """Test two databases writing to the same repo."""
+
+    def openWriters(self):
+        """Return two writable databases that have read every table."""
+        dbs = [Database.loadDatabase(self.repo, None, False) for _ in range(2)]
+        for db in dbs:
+            for tbl in db.tables():
+                tbl.getAllRaw()
+        return dbs
+
+    def check_merge(self):
+        """Ensure results added to one sample by both writers are kept."""
+        self.repo.addResultSchema('single', ['txt'])
+        makeResult(self.repo, 'res2', 'single', ['file_a'])
+        makeResult(self.repo, 'res3', 'single', ['file_b'])
+        self.repo.flush()
+        first, second = self.openWriters()
+        for db, resName in [(first, 'res2'), (second, 'res3')]:
+            rawRec = dict(db.sampleTable.getRaw('samp'))
+            rawRec['results'] = rawRec['results'] + [db.asPK(resName)]
+            db.sampleTable.update('samp', rawRec)
+        first.fileTable.rename('file_a', 'file_a2')
+        first.close()
+        second.close()
+        db = self.reopenDatabase()
+        results = set(db.sampleTable.getRaw('samp')['results'])
+        assert results == db.asPKs(['res', 'res2', 'res3'])
+        assert db.fileTable.exists('file_a2')
+
+    def test_merge_json(self):
+        """Ensure concurrent changes merge with the JSON backend."""
+        self.check_merge()
+
+    def test_merge_sqlite(self):
+        """Ensure concurrent changes merge with the SQLite backend."""
+        Database.migrate(self.repo, SQLiteBackend.name)
+        self.repo.db = Database.loadDatabase(self.repo, None, False)
+        self.check_merge()
+
+    def test_conflict(self):
+        """Ensure conflicting renames raise and leave the repo unchanged."""
+        first, second = self.openWriters()
+        first.sampleTable.rename('samp', 'samp2')
+        second.sampleTable.rename('samp', 'samp3')
+        first.flush()
+        with self.assertRaises(ConcurrentWriteError):
+            second.flush()
+        assert self.reopenDatabase().sampleTable.exists('samp2')
+
+    def test_merge_keeps_name_index(self):
+        """Ensure names merged by one writer are not hidden by the other."""
+        first, second = self.openWriters()
+        first.fileTable.rename('file_a', 'file_a2')
+        first.flush()
+        second.fileTable.rename('file_b', 'file_b2')
+        second.flush()
+        first.close()
+        db = self.reopenDatabase()
+        assert db.fileTable.asPK('file_b2') == second.fileTable.asPK('file_b2')
+        assert not db.nameNotUsed('file_b2')
+        assert db.nameNotUsed('file_b')
+
+
+class TestRepoConfig(BaseTestDatabase):
+    """Test the cached repo configuration."""
+
+    def test_reopen(self):
+        """Ensure types and schemas are read back by a new repo."""
+        RepoConfig._loaded.clear()
+        repo = Repo.loadRepo()
+        assert repo.getSampleTypes() == ['env']
+        assert repo.getFileTypeExt('txt') == 'txt'
+        assert dict(repo.getResultSchema('pair')) == {'a': 'txt', 'b': 'txt'}
+        assert os.path.isfile(os.path.join(repo.abspath, RepoConfig.cacheName))
+
+    def test_config_attributes(self):
+        """Ensure the config is readable through the repo attributes."""
+        repo = Repo.loadRepo()
+        assert repo.sampleTypes == {'env'}
+        assert dict(repo.fileTypes) == {'txt': 'txt'}
+        assert dict(repo.resultSchema['pair']) == {'a': 'txt', 'b': 'txt'}
+        repoId = repo.repoId()
+        assert repo.repoMeta['repo_id'] == repoId
+        with self.assertRaises(TypeError):
+            repo.fileTypes['gz'] = 'gz'
+
+    def test_yaml_changes_invalidate_cache(self):
+        """Ensure the cache is not used once a YAML file changes."""
+        with open(os.path.join(self.repo.abspath, Repo.sampleTypesRoot), 'w') as f:
+            f.write('- env\n- soil\n')
+        assert 'soil' in Repo.loadRepo().getSampleTypes()
+
+    def test_config_does_not_open_database(self):
+        """Ensure reading types and the repo id leaves the database closed."""
+        repo = Repo.loadRepo()
+        repo.getSampleTypes()
+        repo.repoId()
+        assert repo._db is None
+
+    def test_cli_import_is_light(self):
+        """Ensure importing the CLI does not import the database."""
+        code = ('import sys, datasuper.cli; '
+                'print("datasuper.database" in sys.modules, "yaml" in sys.modules)')
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+        assert out.stdout.split() == ['False', 'False']
+
+
+class TestRepoServer(BaseTestDatabase):
+    """Test running CLI commands in a repo server."""
+
+    def setUp(self):
+        super(TestRepoServer, self).setUp()
+        from datasuper.cli import main
+        self.server = RepoServer(self.repo, main)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+        self.client = RepoClient(self.repo.abspath)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        super(TestRepoServer, self).tearDown()
+
+    def test_commands(self):
+        """Ensure commands run in the server and their changes are saved."""
+        assert self.client.running()
+        exitCode, out, _ = self.client.run(['view', 'samples'])
+        assert exitCode == 0
+        assert out.split() == ['samp', 'env']
+        exitCode, _, _ = self.client.run(['add', 'file', 'file_c', 'a.txt', 'txt'])
+        assert exitCode == 0
+        assert self.reopenDatabase().fileTable.size() == 3
+        exitCode, _, err = self.client.run(['add', 'file', 'file_c', 'a.txt', 'txt'])
+        assert exitCode == 1
+        assert 'RecordExistsError' in err
+
+    def test_second_server_refused(self):
+        """Ensure only one server runs for a repo."""
+        with self.assertRaises(ServerRunningError):
+            RepoServer(self.repo, None)
+
+    def test_statuses_follow_files(self):
+        """Ensure statuses cached by one command are not reused by the next."""
+        _, out, _ = self.client.run(['status'])
+        assert 'failed' not in out
+        os.remove('b.txt')
+        _, _, err = self.client.run(['remove', 'invalids'])
+        assert 'Removing 1 samples objects' in err
+        assert 'Removing 1 results objects' in err
+        _, out, _ = self.client.run(['status'])
+        assert 'file_b failed: file_not_found' in out
+
+    def test_sees_changes_from_other_processes(self):
+        """Ensure the server reloads a database changed by another writer."""
+        self.client.run(['view', 'files'])
+        other = Repo(self.repo.abspath)
+        other.readOnly = False
+        makeFile(other, 'file_c', 'a.txt', 'txt')
+        other.flush()
+        _, out, _ = self.client.run(['view', 'files'])
+        assert 'file_c' in out
+
+    def test_migrate(self):
+        """Ensure the server opens the new database after a migration."""
+        self.client.run(['view', 'files'])
+        Database.migrate(Repo(self.repo.abspath), SQLiteBackend.name)
+        exitCode, _, _ = self.client.run(['add', 'file', 'file_c', 'a.txt', 'txt'])
+        assert exitCode == 0
+        _, out, _ = self.client.run(['view', 'files'])
+        assert 'file_a' in out
+        db = self.reopenDatabase()
+        assert isinstance(db.backend, SQLiteBackend)
+        assert db.fileTable.size() == 3
+
+
+class TestBatch(BaseTestDatabase):
+    """Test running many CLI commands in one transaction."""
+
+    def runBatch(self, lines):
+        from click.testing import CliRunner
+        from datasuper.cli import main
+        return CliRunner().invoke(main, ['batch'], input='\n'.join(lines))
+
+    def test_batch(self):
+        """Ensure every command of a batch is saved."""
+        result = self.runBatch([
+            '# comment',
+            'add file file_c a.txt txt',
+            '["add", "file", "file d", "b.txt", "txt"]',
+            'add result res2 pair a:file_c b:"file d"',
+            'add results-to-sample samp res2',
+        ])
+        assert result.exit_code == 0, result.output
+        db = self.reopenDatabase()
+        assert db.fileTable.size() == 4
+        assert len(db.sampleTable.getRaw('samp')['results']) == 2
+
+    def test_failure_saves_nothing(self):
+        """Ensure failing lines are reported and nothing is saved."""
+        result = self.runBatch([
+            'add file file_c a.txt txt',
+            'add file file_a a.txt txt',
+            'add nothing',
+        ])
+        assert result.exit_code == 1
+        assert 'line 2: RecordExistsError' in result.output
+        assert 'line 3: No such command' in result.output
+        assert self.reopenDatabase().fileTable.size() == 2
+
+    def test_commands_with_transactions(self):
+        """Ensure commands opening their own transaction can follow others."""
+        self.repo.addFileType('gz_fastq')
+        self.repo.addResultSchema('raw_short_read_dna',
+                                  {'read1': 'gz_fastq', 'read2': 'gz_fastq'})
+        for fname in ['s2_1.fastq.gz', 's2_2.fastq.gz']:
+            with open(fname, 'w') as f:
+                f.write(fname)
+        result = self.runBatch([
+            'add sample s1 env',
+            'bio add-fastqs env s2_1.fastq.gz s2_2.fastq.gz',
+            'add sample s3 env',
+        ])
+        assert result.exit_code == 0, result.output
+        db = self.reopenDatabase()
+        assert db.sampleTable.size() == 4
+        assert db.fileTable.size() == 4
+        assert len(db.sampleTable.getRaw('s2')['results']) == 1
+
+    def test_lines_are_not_forwarded(self):
+        """Ensure a batch runs here even while a server runs for the repo."""
+        packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=packageRoot)
+        env.pop('DATASUPER_LOCAL', None)
+        server = subprocess.Popen(
+            [sys.executable, '-c', 'from datasuper.cli import main; main()',
+             'serve'],
+            env=env, stderr=subprocess.DEVNULL
+        )
+        try:
+            client = RepoClient(self.repo.abspath)
+            for _ in range(200):
+                if client.running():
+                    break
+                time.sleep(0.05)
+            assert client.running()
+            result = self.runBatch([
+                'add file file_c a.txt txt',
+                'add file file_a a.txt txt',
+            ])
+            assert result.exit_code == 1
+            assert 'line 2: RecordExistsError' in result.output
+            assert 'Traceback' not in result.output
+        finally:
+            server.terminate()
+            server.wait()
+        assert self.reopenDatabase().fileTable.size() == 2